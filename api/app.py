@@ -1,8 +1,10 @@
 import os
+import socket
 import time
 from datetime import datetime
 
 from flask import Flask
+from werkzeug.serving import make_server
 
 
 app = Flask(__name__)
@@ -37,10 +39,34 @@ def timeout():
     time.sleep(60)
 
 
+def notify_ready():
+    """Notifies the process that started this server that it is ready, in the
+    style of sd_notify, if it provided a NOTIFY_SOCKET"""
+    notify_socket = os.environ.get("NOTIFY_SOCKET")
+    if notify_socket:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            try:
+                sock.sendto(b"READY=1", notify_socket)
+            except OSError:
+                # The starting process may have already seen the port open
+                pass
+
+
 # For running in a local Python environment, which be started by running:
 # PORT=8000 python app.py
+# or to listen on a Unix domain socket instead of a TCP port:
+# SOCKET_PATH=/tmp/api.sock python app.py
 if __name__ == "__main__":
     PORT = int(os.environ.get("PORT", 8000))
-    app.run(
-        host="0.0.0.0", port=PORT,
+    SOCKET_PATH = os.environ.get("SOCKET_PATH")
+    # Werkzeug's server closes the connection after each response, so the proxy
+    # can't reuse connections to it; a server with keep-alive, or API_WSGI to call
+    # the app in the proxy process, avoids connecting for each request
+    server = make_server(
+        host=f"unix://{SOCKET_PATH}" if SOCKET_PATH else "0.0.0.0",
+        port=PORT,
+        app=app,
+        threaded=True,
     )
+    notify_ready()
+    server.serve_forever()
@@ -42,6 +42,23 @@ echo -e "${cyan}- Copying /${static_path}...${nocolor}"
 mkdir -p "${temp_build_path}/${static_path}"
 cp -R "$static_abspath" "$(dirname "${temp_build_path}/${static_path}")"
 
+# Source maps are left out of the package
+find "${temp_build_path}/${static_path}" -type f -name "*.map" -delete
+
+# Precompress text files, so they can be served to clients accepting gzip or brotli
+echo -e "${cyan}- Precompressing static files...${nocolor}"
+compressible=(-name "*.html" -o -name "*.js" -o -name "*.css" -o -name "*.json" -o -name "*.svg" -o -name "*.txt")
+find "${temp_build_path}/${static_path}" -type f \( "${compressible[@]}" \) -exec gzip -9 -k -n {} +
+if command -v brotli > /dev/null; then
+    find "${temp_build_path}/${static_path}" -type f \( "${compressible[@]}" \) -exec brotli -q 11 -k {} +
+else
+    echo "brotli not found, skipping brotli variants"
+fi
+
+# Index static files, so they don't need to be listed and read at startup
+echo -e "${cyan}- Writing static file manifest...${nocolor}"
+(cd "$temp_build_path" && python3 proxy.py --write-static-manifest static-manifest.json)
+
 # Install dependencies, using a Docker image to correctly build native extensions
 echo -e "${cyan}- Installing Python dependencies...${nocolor}"
 docker run --rm -t -v "$temp_build_path:/code" -w /code lambci/lambda:build-$runtime \
@@ -3,6 +3,8 @@ proxy.py is a shim to run a Python API server and JavaScript web application on
 
 The Python API server:
 - must run with the command `python api/app.py` or set by API_COMMAND
+- or may instead be imported and called in-process as a WSGI or ASGI application, set by
+  API_WSGI or API_ASGI
 - must run a web server listening to requests on the port provided in the PORT env var
 - should expect to receive requests on the `/api` path only
 - must have its dependencies installed to .pypath/ using `pip install -r requirements.txt -t .pypath/`
@@ -14,59 +16,308 @@ The JavaScript web application:
 - may make requests to the API server at the host-relative path `/api`
 
 Known issues / areas of improvement:
-- if the API server process terminates, there is no polling to detect this or restart it
 - doesn't pass through all context data, such as source IP
-- no caching implemented, such as support for Expires, If-Modified-Since, If-Match
+- limited caching implemented, no support for Expires, If-Match
 - better handling of failure scenarios, such as timeouts and server errors
 - handling of CORS headers
 - development mode to pass requests to Python and Webpack dev servers
 """
+import argparse
+import asyncio
 import base64
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import mmap
 import os
+import re
+import secrets
+import select
+import selectors
+import shlex
+import signal
 import socket
+import stat
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+import traceback
+import zlib
+from collections import OrderedDict, deque
 from email.message import Message
-from http.client import HTTPConnection
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from functools import lru_cache
+from http import HTTPStatus
+from http.client import HTTPConnection, HTTPResponse, RemoteDisconnected
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from mimetypes import guess_type
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Tuple
-from urllib.parse import parse_qs, urlencode, urlparse
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Tuple,
+    Union,
+)
+from urllib.parse import parse_qs, unquote, unquote_to_bytes, urlencode, urlparse
 
 
 # Command to start the API server, which must listen on the port specified in
 # the PORT environment variable it is provided
 API_COMMAND = os.environ.get("API_COMMAND", "python api/app.py")
 
+# WSGI application to call in-process instead of starting the API server, given
+# as `module:attribute` such as `api.app:app`
+API_WSGI = os.environ.get("API_WSGI", "")
+
+# ASGI application to call in-process instead of starting the API server, given
+# as `module:attribute`, which is run on an event loop kept across requests
+API_ASGI = os.environ.get("API_ASGI", "")
+
 # Time to wait for API server to start, in seconds
 API_START_TIMEOUT = int(os.environ.get("API_START_TIMEOUT", 5))
 
+# Whether to start API server processes by forking a template interpreter that
+# has already imported the API_COMMAND script, which must be `python <script>`
+API_ZYGOTE = os.environ.get("API_ZYGOTE", "") == "1"
+
+# When to start the API server: "eager" blocks initialisation until it's ready,
+# "background" starts it without blocking so that static files are served at
+# once, and "lazy" waits to start it until the first request to the API
+API_START = os.environ.get("API_START", "eager")
+
 # Location of the static files to be served, should be the output from
 # the production build of the web application
 STATIC_PATH = os.environ.get("STATIC_PATH", "app/build")
 
+# Location of the manifest of static files written by the build, which is used
+# instead of listing and reading the static files at startup if it exists
+STATIC_MANIFEST_PATH = os.environ.get("STATIC_MANIFEST_PATH", "static-manifest.json")
+
+# Cache-Control policy for static files that are neither content-hashed, which
+# are cached forever, nor entrypoints such as index.html, which are revalidated
+STATIC_CACHE_CONTROL = os.environ.get("STATIC_CACHE_CONTROL", "no-cache")
+
+# Pattern of static file paths with a content hash, such as the output of Webpack
+# builds `static/js/main.5ecd60fb.chunk.js`, which are safe to cache forever
+STATIC_IMMUTABLE_PATTERN = os.environ.get(
+    "STATIC_IMMUTABLE_PATTERN", r"\.[0-9a-f]{8,}\.(chunk\.)?[a-z0-9]+$"
+)
+
+# Maximum total size of static files to hold in memory, in bytes
+STATIC_CACHE_SIZE = int(os.environ.get("STATIC_CACHE_SIZE", 64 * 1024 * 1024))
+
+# Development mode, where changes to static files are picked up without restarting
+DEV_MODE = os.environ.get("DEV_MODE", "") == "1"
+
 # Port for the proxy server to listen on, when running as a local web server
 PROXY_PORT = int(os.environ.get("PORT", 8000))
 
+# Server to use when running as a local web server: "threads" handles each
+# connection on a thread from a pool, and "asyncio" handles connections and API
+# requests on an event loop, using threads only for static files
+PROXY_SERVER = os.environ.get("PROXY_SERVER", "threads")
+
+# Number of threads handling requests, when running as a local web server
+PROXY_THREADS = int(os.environ.get("PROXY_THREADS", 16))
+
+# Maximum number of connections being handled or waiting for a thread, beyond
+# which new connections wait to be accepted, when running as a local web server
+PROXY_MAX_IN_FLIGHT = int(os.environ.get("PROXY_MAX_IN_FLIGHT", 64))
+
+# Time after which an idle keep-alive connection from a client is closed, in
+# seconds, when running as a local web server
+PROXY_KEEP_ALIVE_TIMEOUT = float(os.environ.get("PROXY_KEEP_ALIVE_TIMEOUT", 15))
+
+# Number of connections waiting to be accepted that the OS queues before refusing
+# new connections, when running as a local web server
+PROXY_ACCEPT_QUEUE = int(os.environ.get("PROXY_ACCEPT_QUEUE", 128))
+
 # Path
 PATH = os.environ.get("PATH", "")
 
+# Number of API server processes to start, on consecutive ports from 8180; with
+# multiple proxy processes (`--workers`), each starts its own on the next ports.
+# Defaults to the number of CPUs when running as a local web server, and to 1 on
+# Lambda, where each container handles one request at a time.
+API_WORKERS = int(os.environ.get("API_WORKERS", 0))
+
+# Whether to keep a spare API server process running, to replace any that exit
+API_STANDBY = os.environ.get("API_STANDBY", "") == "1"
+
+# Path of a Unix domain socket for the API server to listen on, which it is
+# provided in the SOCKET_PATH environment variable; if the API server doesn't
+# bind to it, requests are sent to the PORT over TCP instead. With multiple
+# API server processes, the index of each is appended to the path.
+API_SOCKET_PATH = os.environ.get("API_SOCKET_PATH", "")
 
-def one_time_init():
-    """One-time initialisation, of API server process and proxy application"""
-    api_server_host, api_server_port = "localhost", 8180
-    one_time_init.api_process = start_api_server_process(
-        command=API_COMMAND,
-        host=api_server_host,
-        port=api_server_port,
-        start_timeout=API_START_TIMEOUT,
-        path=PATH,
+# Maximum number of idle keep-alive connections to the API server to hold open;
+# they're only reused if the API server keeps connections open, which Werkzeug's
+# development server, as used by api/app.py, doesn't
+API_POOL_SIZE = int(os.environ.get("API_POOL_SIZE", 10))
+
+# Time after which an idle connection to the API server is discarded, in seconds
+API_POOL_IDLE_TIMEOUT = float(os.environ.get("API_POOL_IDLE_TIMEOUT", 30))
+
+# Maximum number of requests in flight to each API server process, or to the
+# in-process application, beyond which requests are queued; 0 for no limit
+API_MAX_IN_FLIGHT = int(os.environ.get("API_MAX_IN_FLIGHT", 10))
+
+# Maximum number of API requests to queue when the API is at its limit, beyond
+# which requests are rejected at once with 503 Service Unavailable
+API_MAX_QUEUE = int(os.environ.get("API_MAX_QUEUE", 50))
+
+# Time an API request waits in the queue before being rejected, in seconds
+API_MAX_QUEUE_TIME = float(os.environ.get("API_MAX_QUEUE_TIME", 2))
+
+# Seconds that clients are asked to wait before retrying rejected API requests,
+# given in the Retry-After header
+API_RETRY_AFTER = int(os.environ.get("API_RETRY_AFTER", 1))
+
+# Compression level (1-9) for API responses, or 0, the default, to pass them
+# through unchanged
+API_COMPRESS_LEVEL = int(os.environ.get("API_COMPRESS_LEVEL", 0))
+
+# Minimum size of API response bodies to compress, in bytes
+API_COMPRESS_MIN_SIZE = int(os.environ.get("API_COMPRESS_MIN_SIZE", 1024))
+
+# Maximum total size of compressed API responses to hold in memory, in bytes
+API_COMPRESS_CACHE_SIZE = int(
+    os.environ.get("API_COMPRESS_CACHE_SIZE", 4 * 1024 * 1024)
+)
+
+# Maximum size of request bodies to accept from clients of the local web server,
+# in bytes, above which requests are rejected with 413 Payload Too Large
+PROXY_MAX_BODY_SIZE = int(os.environ.get("PROXY_MAX_BODY_SIZE", 10 * 1024 * 1024))
+
+# Path at which the proxy serves its own status as JSON, such as `/_proxy/status`;
+# disabled by default, as the status includes the API servers' addresses
+PROXY_STATUS_PATH = os.environ.get("PROXY_STATUS_PATH", "")
+
+# Size of chunks in which API responses are relayed, in bytes; smaller responses
+# of known length are read whole, so that they can be compressed and cached
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Request methods that can safely be sent again if the response is lost
+_IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE"))
+
+# Headers that apply to a single connection, so must not be forwarded by a proxy
+_HOP_BY_HOP_HEADERS = frozenset(
+    (
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailers",
+        "transfer-encoding",
+        "upgrade",
     )
+)
+
+# File to which the process group IDs of API server processes are appended, when
+# run by serve_in_processes, so that they can be killed if the proxy process dies
+_api_process_groups_path = None  # type: Optional[str]
+
+
+def one_time_init(
+    static_file_bodies: bool = False, instance: int = 0, api_worker_count: int = 1
+):
+    """One-time initialisation, of API server process and proxy application; with
+    multiple proxy processes, `instance` offsets the API server ports and sockets
+
+    `api_worker_count` is the number of API server processes to start, unless set
+    by API_WORKERS.
+    """
+    api_worker_count = API_WORKERS or api_worker_count
+    one_time_init.api_workers = None
+    one_time_init.api_zygote = None
+    one_time_init.api_asgi_runner = None
+    one_time_init.event_loop = None
+    one_time_init.api_compressor = None
+    one_time_init.api_admission = None
+    api_wsgi_app = None
+    if API_ASGI:
+        one_time_init.event_loop = start_event_loop()
+        one_time_init.api_asgi_runner = AsgiRunner(
+            app=load_app(API_ASGI), loop=one_time_init.event_loop
+        )
+        one_time_init.api_asgi_runner.startup(timeout=API_START_TIMEOUT)
+    elif API_WSGI:
+        api_wsgi_app = load_app(API_WSGI)
+    else:
+        if API_ZYGOTE:
+            one_time_init.api_zygote = Zygote(command=API_COMMAND, path=PATH)
+        workers = []
+        count = api_worker_count + API_STANDBY
+        for index in range(instance * count, (instance + 1) * count):
+            socket_path = API_SOCKET_PATH or None
+            if socket_path and (count > 1 or instance):
+                socket_path += f".{index}"
+            workers.append(
+                ApiWorker(
+                    command=API_COMMAND,
+                    host="localhost",
+                    port=8180 + index,
+                    start_timeout=API_START_TIMEOUT,
+                    path=PATH,
+                    socket_path=socket_path,
+                    zygote=one_time_init.api_zygote,
+                )
+            )
+        one_time_init.api_workers = ApiWorkerPool(
+            workers=workers[:api_worker_count],
+            standby=workers[api_worker_count] if API_STANDBY else None,
+        )
+        if API_START == "eager":
+            one_time_init.api_workers.start()
+        elif API_START == "background":
+            one_time_init.api_workers.start_in_background()
+        elif API_START != "lazy":
+            raise ValueError(f"Unknown API_START: {API_START}")
+    if API_MAX_IN_FLIGHT:
+        # The limit applies to each API server process, so scales with them
+        backends = api_worker_count if one_time_init.api_workers is not None else 1
+        one_time_init.api_admission = AdmissionController(
+            max_in_flight=API_MAX_IN_FLIGHT * backends,
+            max_queue=API_MAX_QUEUE,
+            max_queue_time=API_MAX_QUEUE_TIME,
+            retry_after=API_RETRY_AFTER,
+        )
+    if API_COMPRESS_LEVEL:
+        one_time_init.api_compressor = ResponseCompressor(
+            level=API_COMPRESS_LEVEL,
+            min_size=API_COMPRESS_MIN_SIZE,
+            cache_size=API_COMPRESS_CACHE_SIZE,
+        )
     one_time_init.proxy_app = make_proxy_app(
         static_path=STATIC_PATH,
-        api_server_host=api_server_host,
-        api_server_port=api_server_port,
+        static_manifest_path=STATIC_MANIFEST_PATH,
+        static_cache_control=STATIC_CACHE_CONTROL,
+        static_immutable_pattern=STATIC_IMMUTABLE_PATTERN,
+        static_file_bodies=static_file_bodies,
+        static_cache_size=STATIC_CACHE_SIZE,
+        dev_mode=DEV_MODE,
+        api_workers=one_time_init.api_workers,
+        api_wsgi_app=api_wsgi_app,
+        api_asgi_runner=one_time_init.api_asgi_runner,
+        api_compressor=one_time_init.api_compressor,
+        api_admission=one_time_init.api_admission,
+        status_path=PROXY_STATUS_PATH,
     )
 
 
@@ -103,6 +354,8 @@ def lambda_handler(event, context) -> Dict:
     )
 
     # Encode the response for API Gateway 2.0
+    if isinstance(response_body, (FileBody, ResponseStream)):
+        response_body = response_body.read()
     if _is_binary_content(response_headers):
         is_base64_encoded = True
         response_body = base64.standard_b64encode(response_body)
@@ -128,10 +381,57 @@ def lambda_handler(event, context) -> Dict:
 
 def main():
     """Entrypoint for use as local web server, for testing purposes"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--write-static-manifest",
+        metavar="PATH",
+        help="write the manifest of static files to PATH, then exit",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="number of proxy server processes sharing the port, each with its own "
+        "API server processes",
+    )
+    args = parser.parse_args()
+    if args.write_static_manifest:
+        manifest = build_static_manifest(STATIC_PATH)
+        write_static_manifest(manifest, args.write_static_manifest)
+        print(f"Wrote {len(manifest)} static files to {args.write_static_manifest}")
+        return
+    if args.workers > 1:
+        serve_in_processes(args.workers)
+    else:
+        serve()
+
+
+def serve(instance: int = 0, reuse_port: bool = False):
+    """Runs the local web server until interrupted, as proxy process `instance`"""
+    # Static files are sent from disk with sendfile, rather than held in memory
+    one_time_init(
+        static_file_bodies=True, instance=instance, api_worker_count=os.cpu_count() or 1
+    )
     proxy_host, proxy_port = "", PROXY_PORT
 
     class RequestHandler(BaseHTTPRequestHandler):
+        # Keep connections open between requests, which the server waits on while
+        # they're idle, so that they don't hold a thread
+        protocol_version = "HTTP/1.1"
+        timeout = PROXY_KEEP_ALIVE_TIMEOUT
+
+        def handle(self):
+            self.close_connection = True
+            self.handle_one_request()
+
+        def finish(self):
+            if self.close_connection:
+                super().finish()
+
         def do_request(self):
+            headers_sent = False
+            response_body = None
             try:
                 # Parse the HTTP request
                 method = self.command
@@ -143,9 +443,22 @@ def main():
                         headers[name].append(value)
                     else:
                         headers[name] = [value]
-                length = int(self.headers.get("Content-Length", 0))
-                if length:
-                    body = self.rfile.read(length)
+                # Request bodies are streamed, rather than read before proxying
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                except ValueError:
+                    length = -1
+                transfer_encoding = self.headers.get("Transfer-Encoding", "")
+                if length < 0:
+                    self.send_error(400, "Bad Request")
+                    return
+                elif length > PROXY_MAX_BODY_SIZE:
+                    self.send_error(413, "Payload Too Large")
+                    return
+                elif "chunked" in transfer_encoding.lower():
+                    body = RequestStream(self.rfile, None, PROXY_MAX_BODY_SIZE)
+                elif length:
+                    body = RequestStream(self.rfile, length, PROXY_MAX_BODY_SIZE)
                 else:
                     body = None
                 timeout = 15
@@ -160,17 +473,77 @@ def main():
                     timeout=timeout,
                 )
 
-                # Send as an HTTP response
-                self.send_response(status)
+                # Send as an HTTP response, with streamed bodies of unknown length
+                # sent in chunks if possible, or else ended by closing the connection
+                is_stream = isinstance(response_body, ResponseStream)
+                length = _get_header(response_headers, "Content-Length")
+                chunked = False
+                if is_stream and length is None:
+                    chunked = self.request_version == "HTTP/1.1"
+                    self.close_connection = self.close_connection or not chunked
+                elif length is None and self._has_body(method, status):
+                    response_body = response_body or b""
+                    length = str(
+                        response_body.length
+                        if isinstance(response_body, FileBody)
+                        else len(response_body)
+                    )
+                    response_headers = {**response_headers, "Content-Length": [length]}
+                # Any unread request body would be taken as the next request
+                if isinstance(body, RequestStream) and not body.finished:
+                    self.close_connection = True
+                self.log_request(status)
+                self.send_response_only(status)
+                # The API server's own Server and Date headers are passed through
+                if _get_header(response_headers, "Server") is None:
+                    self.send_header("Server", self.version_string())
+                if _get_header(response_headers, "Date") is None:
+                    self.send_header("Date", self.date_time_string())
                 for name, values in response_headers.items():
+                    if name.lower() == "connection":
+                        continue
                     for value in values:
                         self.send_header(name, value)
+                if chunked:
+                    self.send_header("Transfer-Encoding", "chunked")
+                if self.close_connection:
+                    self.send_header("Connection", "close")
                 self.end_headers()
-                if response_body:
+                headers_sent = True
+                if is_stream:
+                    for chunk in response_body:
+                        if not chunk:
+                            continue
+                        if chunked:
+                            chunk = b"%x\r\n%s\r\n" % (len(chunk), chunk)
+                        self.wfile.write(chunk)
+                    if chunked:
+                        self.wfile.write(b"0\r\n\r\n")
+                elif isinstance(response_body, FileBody):
+                    # sendfile rejects a count of zero, as for empty files
+                    if response_body.length:
+                        with open(response_body.path, "rb") as file:
+                            self.connection.sendfile(
+                                file, response_body.offset, response_body.length
+                            )
+                elif response_body:
                     self.wfile.write(response_body)
             except Exception as e:
-                self.send_error(500, "Internal Server Error")
+                # A response that has been started can only be cut short
+                if headers_sent:
+                    self.close_connection = True
+                else:
+                    self.send_error(500, "Internal Server Error")
                 raise e
+            finally:
+                # Closing a stream releases the API server it's relayed from, even
+                # if the client went away before the response was started
+                if isinstance(response_body, ResponseStream):
+                    response_body.close()
+
+        def _has_body(self, method: str, status: int) -> bool:
+            """Returns True if a response to the request has a body, even if empty"""
+            return method != "HEAD" and status >= 200 and status not in (204, 304)
 
         do_DELETE = do_request
         do_GET = do_request
@@ -179,59 +552,379 @@ def main():
         do_POST = do_request
         do_PUT = do_request
 
-    httpd = HTTPServer((proxy_host, proxy_port), RequestHandler)
+    if PROXY_SERVER == "asyncio":
+        httpd = AsyncHTTPServer(
+            (proxy_host, proxy_port),
+            make_async_proxy_app(
+                proxy_app=one_time_init.proxy_app,
+                api_workers=one_time_init.api_workers,
+                api_compressor=one_time_init.api_compressor,
+                api_admission=one_time_init.api_admission,
+            ),
+            max_threads=PROXY_THREADS,
+            accept_queue_size=PROXY_ACCEPT_QUEUE,
+            max_body_size=PROXY_MAX_BODY_SIZE,
+            keep_alive_timeout=PROXY_KEEP_ALIVE_TIMEOUT,
+            reuse_port=reuse_port,
+        )
+    elif PROXY_SERVER == "threads":
+        httpd = ThreadPoolHTTPServer(
+            (proxy_host, proxy_port),
+            RequestHandler,
+            max_threads=PROXY_THREADS,
+            max_in_flight=PROXY_MAX_IN_FLIGHT,
+            accept_queue_size=PROXY_ACCEPT_QUEUE,
+            keep_alive_timeout=PROXY_KEEP_ALIVE_TIMEOUT,
+            reuse_port=reuse_port,
+        )
+    else:
+        raise ValueError(f"Unknown PROXY_SERVER: {PROXY_SERVER}")
 
     print(f"Proxy server running at {proxy_host}:{proxy_port} ...")
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("Terminating...")
-        one_time_init.api_process.terminate()
+    finally:
+        httpd.server_close()
+        if one_time_init.api_workers:
+            one_time_init.api_workers.terminate()
+        if one_time_init.api_zygote:
+            one_time_init.api_zygote.terminate()
+        if one_time_init.api_asgi_runner:
+            one_time_init.api_asgi_runner.shutdown(timeout=API_START_TIMEOUT)
 
 
-def start_api_server_process(
-    command: str, host: str, port: int, start_timeout: int, path: str
-) -> subprocess.Popen:
-    print(f"Starting API server on {host}:{port} ...")
-    process = subprocess.Popen(
-        command,
-        shell=True,
-        env={"PATH": path, "PORT": str(port), "PYTHONPATH": ".pypath/"},
-        stdin=None,
-        text=True,
-    )
-    end_time = time.monotonic() + start_timeout
-    while True:
-        time.sleep(0.01)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Check if port is open
-        if sock.connect_ex((host, port)) == 0:
-            break
-        if time.monotonic() >= end_time:
-            process.terminate()
-            raise RuntimeError("Timeout waiting for API server to start")
-    print(f"API server started")
-    return process
+def serve_in_processes(count: int, restart_backoff=0.1, restart_backoff_max=10):
+    """Runs the local web server in `count` forked processes sharing the port with
+    SO_REUSEPORT, so that the kernel balances connections between them, and
+    restarts any that exit until interrupted"""
+    processes = {}  # type: Dict[int, Tuple[int, float]]
+    failures = [0] * count
+    # Terminate gracefully, so that API server processes are terminated too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
+    def process_groups_path(instance: int) -> str:
+        return os.path.join(
+            tempfile.gettempdir(), f"proxy-api-pgids-{os.getpid()}-{instance}"
+        )
 
-def make_proxy_app(
-    static_path: str, api_server_host: str, api_server_port: int
-) -> Callable:
-    """Builds the proxy server application and returns the root request handler"""
+    def start(instance: int):
+        path = process_groups_path(instance)
+        pid = os.fork()
+        if pid == 0:
+            global _api_process_groups_path
+            _api_process_groups_path = path
+            # Interrupts are passed on by the supervisor, rather than received
+            # from the terminal along with it; the group also holds the zygote
+            # and the processes forked from it
+            os.setpgid(0, 0)
+            exit_code = 1
+            try:
+                serve(instance=instance, reuse_port=True)
+                exit_code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(exit_code)
+        processes[pid] = (instance, time.monotonic())
 
-    def _root_handler(
-        method: str,
-        path: str,
-        query: Dict[str, List[str]],
-        headers: Dict[str, List[str]],
-        body: Optional[bytes],
-        timeout: float,
-    ) -> Tuple[int, Dict[str, List[str]], Optional[bytes]]:
-        """Root request handler"""
-        if path == "/":
-            return _static_handler(method=method, path="/index.html")
-        elif path.startswith("/api/"):
-            return _api_server_handler(
+    for instance in range(count):
+        start(instance)
+    try:
+        while True:
+            pid, status = os.wait()
+            instance, started_at = processes.pop(pid)
+            # Kill any API servers left behind, such as when the proxy process is
+            # killed, as they'd hold on to the ports of its replacement
+            _kill_process_groups(pid, process_groups_path(instance))
+            # Back off when a proxy process keeps failing soon after starting
+            if time.monotonic() - started_at >= 30:
+                failures[instance] = 0
+            delay = 0.0
+            if failures[instance]:
+                delay = min(
+                    restart_backoff * 2 ** (failures[instance] - 1),
+                    restart_backoff_max,
+                )
+            failures[instance] += 1
+            print(
+                f"Proxy process {instance} (pid {pid}) exited with status {status}, "
+                f"restarting in {delay:.1f}s ..."
+            )
+            time.sleep(delay)
+            start(instance)
+    except KeyboardInterrupt:
+        print("Terminating proxy processes...")
+        for pid in processes:
+            os.kill(pid, signal.SIGINT)
+        for pid, (instance, _) in processes.items():
+            os.waitpid(pid, 0)
+            _kill_process_groups(pid, process_groups_path(instance))
+
+
+def _kill_process_groups(pgid: int, path: str):
+    """Kills the process group `pgid`, and those listed in the file at `path`,
+    which is then removed"""
+    pgids = {pgid}
+    try:
+        with open(path) as file:
+            pgids.update(int(line) for line in file)
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    for group in pgids:
+        try:
+            os.killpg(group, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTP server that handles requests on a bounded pool of threads
+
+    Handlers handle one request at a time. Idle keep-alive connections don't hold
+    a thread: they're watched by a selector, and handed back to the pool once the
+    next request arrives, or closed after `keep_alive_timeout`.
+    """
+
+    def __init__(
+        self,
+        server_address: Tuple[str, int],
+        handler_class: Callable,
+        max_threads: int,
+        max_in_flight: int,
+        accept_queue_size: int,
+        keep_alive_timeout: float = 60,
+        reuse_port: bool = False,
+    ):
+        self.request_queue_size = accept_queue_size
+        self.reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_threads, thread_name_prefix="proxy"
+        )
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.keep_alive_timeout = keep_alive_timeout
+        # Idle connections, by handler, with the time at which they're closed
+        self._idle = {}  # type: Dict[BaseHTTPRequestHandler, float]
+        self._idle_lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
+        threading.Thread(
+            target=self._watch_idle, name="proxy-idle", daemon=True
+        ).start()
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        # Stop accepting connections while too many are in flight, so that the
+        # excess wait in the OS accept queue rather than in memory
+        self.in_flight.acquire()
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            self.in_flight.release()
+            return
+        self._continue(handler)
+
+    def _resume(self, handler: BaseHTTPRequestHandler):
+        try:
+            handler.handle_one_request()
+        except Exception:
+            handler.close_connection = True
+            self.handle_error(handler.request, handler.client_address)
+        self._continue(handler)
+
+    def _continue(self, handler: BaseHTTPRequestHandler):
+        """Handles requests already sent on a connection, then closes it or sets
+        it aside until the next request arrives"""
+        try:
+            while not handler.close_connection and _has_buffered_input(handler):
+                handler.handle_one_request()
+        except Exception:
+            handler.close_connection = True
+            self.handle_error(handler.request, handler.client_address)
+        self.in_flight.release()
+        if handler.close_connection:
+            self._close(handler)
+            return
+        with self._idle_lock:
+            self._idle[handler] = time.monotonic() + self.keep_alive_timeout
+        self._wakeup_writer.send(b"\0")
+
+    def _close(self, handler: BaseHTTPRequestHandler):
+        handler.close_connection = True
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+
+    def _watch_idle(self):
+        """Waits for requests on idle connections, and resubmits them to the pool"""
+        watched = set()
+        while True:
+            with self._idle_lock:
+                for handler in self._idle.keys() - watched:
+                    self._selector.register(
+                        handler.connection, selectors.EVENT_READ, handler
+                    )
+                    watched.add(handler)
+                deadline = min(self._idle.values(), default=None)
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                events = self._selector.select(timeout)
+            except (OSError, ValueError):
+                return  # The server was closed
+            now = time.monotonic()
+            ready = []
+            expired = []
+            with self._idle_lock:
+                for key, _ in events:
+                    if key.data is None and not self._wakeup_reader.recv(4096):
+                        return  # The server was closed
+                    elif key.data in self._idle:
+                        ready.append(key.data)
+                        del self._idle[key.data]
+                for handler, closes_at in list(self._idle.items()):
+                    if closes_at <= now:
+                        expired.append(handler)
+                        del self._idle[handler]
+            for handler in ready + expired:
+                self._selector.unregister(handler.connection)
+                watched.discard(handler)
+            for handler in expired:
+                self._close(handler)
+            for handler in ready:
+                self.in_flight.acquire()
+                self.executor.submit(self._resume, handler)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+        self._selector.close()
+        self._wakeup_writer.close()
+        with self._idle_lock:
+            idle, self._idle = list(self._idle), {}
+        for handler in idle:
+            self._close(handler)
+
+
+class AsyncHTTPServer:
+    """HTTP/1.1 server that handles connections as tasks on an event loop, so that
+    idle keep-alive connections and slow requests don't each hold a thread"""
+
+    def __init__(
+        self,
+        server_address: Tuple[str, int],
+        app: Callable,
+        max_threads: int,
+        accept_queue_size: int,
+        max_body_size: int,
+        keep_alive_timeout: float = 60,
+        reuse_port: bool = False,
+    ):
+        self.app = app
+        self.max_body_size = max_body_size
+        self.keep_alive_timeout = keep_alive_timeout
+        self.socket = socket.create_server(
+            server_address, backlog=accept_queue_size, reuse_port=reuse_port
+        )
+        self.loop = asyncio.new_event_loop()
+        # Used by the app for work that blocks, such as reading static files
+        self.loop.set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_threads, thread_name_prefix="proxy"
+            )
+        )
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(
+            asyncio.start_server(self._handle_connection, sock=self.socket)
+        )
+        self.loop.run_forever()
+
+    def server_close(self):
+        self.socket.close()
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        client_host = writer.get_extra_info("peername", ("-",))[0]
+        try:
+            while await self._handle_request(reader, writer, client_host):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        client_host: str,
+    ) -> bool:
+        """Handles one request on a connection, and returns whether to keep it open
+        for another"""
+        try:
+            request_line = await asyncio.wait_for(
+                reader.readline(), timeout=self.keep_alive_timeout
+            )
+        except asyncio.TimeoutError:
+            return False
+        except (ValueError, asyncio.LimitOverrunError):
+            # The request line is longer than the stream's limit
+            await self._send_error(writer, 400, "Bad Request")
+            return False
+        if not request_line:
+            return False
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+            headers = {}  # type: Dict[str, List[str]]
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers.setdefault(name.strip(), []).append(value.strip())
+        except ValueError:
+            await self._send_error(writer, 400, "Bad Request")
+            return False
+        connection = (_get_header(headers, "Connection") or "").lower()
+        keep_alive = version == "HTTP/1.1" and "close" not in connection
+
+        # Parse the HTTP request
+        _, _, path, _, query_string, _ = urlparse(target)
+        query = parse_qs(query_string)
+        if version == "HTTP/1.1" and _get_header(headers, "Expect") == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        try:
+            body = await self._read_body(reader, headers)
+        except RequestBodyTooLarge:
+            await self._send_error(writer, 413, "Payload Too Large")
+            return False
+        except (ValueError, asyncio.LimitOverrunError):
+            # Malformed chunk sizes or Content-Length
+            await self._send_error(writer, 400, "Bad Request")
+            return False
+        timeout = 15
+
+        # Route the request to the appropriate handler
+        try:
+            status, response_headers, response_body = await self.app(
                 method=method,
                 path=path,
                 query=query,
@@ -239,121 +932,2550 @@ def make_proxy_app(
                 body=body,
                 timeout=timeout,
             )
-        else:
-            return _static_handler(method=method, path=path)
+        except Exception:
+            traceback.print_exc()
+            await self._send_error(writer, 500, "Internal Server Error")
+            return False
+        sys.stderr.write(
+            f"{client_host} - - [{time.strftime('%d/%b/%Y %H:%M:%S')}] "
+            f'"{request_line.decode("latin-1").strip()}" {status} -\n'
+        )
+        return await self._send_response(
+            writer, version, status, response_headers, response_body, keep_alive
+        )
 
-    def _api_server_handler(
-        method: str,
-        path: str,
-        query: Dict[str, List[str]],
+    async def _read_body(
+        self, reader: asyncio.StreamReader, headers: Dict[str, List[str]]
+    ) -> Optional[bytes]:
+        transfer_encoding = _get_header(headers, "Transfer-Encoding") or ""
+        if "chunked" in transfer_encoding.lower():
+            chunks = []
+            size = 0
+            while True:
+                chunk_size = int((await reader.readline()).split(b";", 1)[0], 16)
+                if not chunk_size:
+                    break
+                size += chunk_size
+                if size > self.max_body_size:
+                    raise RequestBodyTooLarge()
+                chunks.append(await reader.readexactly(chunk_size))
+                await reader.readline()
+            # Skip any trailer fields
+            while (await reader.readline()).strip():
+                pass
+            return b"".join(chunks)
+        length = int(_get_header(headers, "Content-Length") or 0)
+        if length < 0:
+            raise ValueError(f"Invalid Content-Length: {length}")
+        if length > self.max_body_size:
+            raise RequestBodyTooLarge()
+        return await reader.readexactly(length) if length else None
+
+    async def _send_response(
+        self,
+        writer: asyncio.StreamWriter,
+        version: str,
+        status: int,
         headers: Dict[str, List[str]],
-        body: Optional[bytes],
-        timeout: float,
-    ) -> Tuple[int, Dict[str, List[str]], Optional[bytes]]:
-        """Resolves requests by proxying to the API server"""
-        url = path
-        if len(query):
-            url += "?" + urlencode(query, doseq=True)
-        # Build a dict-like that supports multiple values per key
-        headers_multi = Message()
+        body: Union[
+            bytes, "FileBody", "ResponseStream", "AsyncResponseStream", None
+        ],
+        keep_alive: bool,
+    ) -> bool:
+        """Sends a response, and returns whether the connection can be kept open"""
+        is_stream = isinstance(body, (ResponseStream, AsyncResponseStream))
+        try:
+            return await self._write_response(
+                writer, version, status, headers, body, keep_alive
+            )
+        finally:
+            # Closing a stream releases the API server it's relayed from
+            if is_stream:
+                body.close()
+
+    async def _write_response(
+        self,
+        writer: asyncio.StreamWriter,
+        version: str,
+        status: int,
+        headers: Dict[str, List[str]],
+        body: Union[
+            bytes, "FileBody", "ResponseStream", "AsyncResponseStream", None
+        ],
+        keep_alive: bool,
+    ) -> bool:
+        is_stream = isinstance(body, (ResponseStream, AsyncResponseStream))
+        chunked = False
+        if _get_header(headers, "Content-Length") is None:
+            if is_stream:
+                # Bodies of unknown length are sent in chunks if possible, or else
+                # ended by closing the connection
+                chunked = version == "HTTP/1.1"
+                keep_alive = keep_alive and chunked
+            elif status >= 200 and status not in (204, 304):
+                length = body.length if isinstance(body, FileBody) else len(body or b"")
+                headers = {**headers, "Content-Length": [str(length)]}
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ""
+        head = [f"HTTP/1.1 {status} {reason}\r\n"]
+        head.append(f"Date: {formatdate(usegmt=True)}\r\n")
         for name, values in headers.items():
+            if name.lower() in ("connection", "date"):
+                continue
             for value in values:
-                headers_multi.add_header(name, value)
+                head.append(f"{name}: {value}\r\n")
+        if chunked:
+            head.append("Transfer-Encoding: chunked\r\n")
+        head.append(f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write("".join(head).encode("latin-1"))
 
-        connection = HTTPConnection(api_server_host, api_server_port, timeout=timeout)
-        connection.request(
-            method=method, url=url, headers=headers_multi, body=body,
+        if isinstance(body, FileBody):
+            await writer.drain()
+            # sendfile rejects a count of zero, as for empty files
+            if body.length:
+                with open(body.path, "rb") as file:
+                    await self.loop.sendfile(
+                        writer.transport, file, body.offset, body.length
+                    )
+        elif is_stream:
+            async for chunk in _iterate_async(body):
+                if not chunk:
+                    continue
+                if chunked:
+                    chunk = b"%x\r\n%s\r\n" % (len(chunk), chunk)
+                writer.write(chunk)
+                # Wait for the client, so memory per request stays bounded
+                await writer.drain()
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+        elif body:
+            writer.write(body)
+        await writer.drain()
+        return keep_alive
+
+    async def _send_error(
+        self, writer: asyncio.StreamWriter, status: int, message: str
+    ):
+        _, headers, body = _text_response(status, message)
+        await self._send_response(
+            writer, "HTTP/1.1", status, headers, body, keep_alive=False
         )
-        response = connection.getresponse()
 
-        status = response.status
-        response_headers = {}
-        for name, value in response.getheaders():
-            if name in response_headers:
-                response_headers[name].append(value)
-            else:
-                response_headers[name] = [value]
-        response_body = response.read()
-        return status, response_headers, response_body
 
-    def _static_handler(
-        method: str, path: str
-    ) -> Tuple[int, Dict[str, List[str]], Optional[bytes]]:
-        """Resolves requests by returning matching files in `static_path`"""
-        method = method.upper()
-        filepath = Path(static_path) / path.lstrip("/")
-        accepted_methods = ("GET", "HEAD")
-        if method in accepted_methods and filepath.exists() and filepath.is_file():
-            if method == "HEAD":
-                response_body = b""
-                content_length = filepath.stat().st_size
-            else:
-                response_body = filepath.read_bytes()
-                content_length = len(response_body)
-            guessed_type = guess_type(path)[0]
-            content_type = guessed_type or "text/plain"
-            return (
-                200,
-                {
-                    "Content-Length": [str(content_length)],
-                    "Content-Type": [content_type],
-                },
-                response_body,
+async def _iterate_async(
+    body: Union["ResponseStream", "AsyncResponseStream"]
+) -> AsyncIterator[bytes]:
+    """Yields the chunks of a response stream, iterating on a thread if it blocks"""
+    if isinstance(body, AsyncResponseStream):
+        async for chunk in body:
+            yield chunk
+        return
+    loop = asyncio.get_running_loop()
+    chunks = iter(body)
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _has_buffered_input(handler: BaseHTTPRequestHandler) -> bool:
+    """Returns True if the next request on a connection has started to arrive,
+    such as when requests are pipelined, without waiting for it"""
+    handler.connection.setblocking(False)
+    try:
+        return bool(handler.rfile.peek(1))
+    except OSError:
+        return False
+    finally:
+        handler.connection.settimeout(handler.timeout)
+
+
+def start_api_server_process(
+    command: str,
+    host: str,
+    port: int,
+    start_timeout: int,
+    path: str,
+    socket_path: Optional[str] = None,
+    zygote: Optional["Zygote"] = None,
+) -> "ApiServer":
+    """Starts the API server and waits for it to be ready to accept requests
+
+    The API server can notify that it is ready by sending `READY=1` in a datagram to
+    the Unix domain socket in its NOTIFY_SOCKET env var, in the style of sd_notify.
+    Otherwise its socket or port is polled, at increasing intervals.
+
+    If a zygote is provided, the process is forked from it rather than running the
+    command.
+    """
+    env = {"PATH": path, "PORT": str(port), "PYTHONPATH": ".pypath/"}
+    if socket_path and not _remove_stale_socket(socket_path):
+        print(f"Not using {socket_path}, which is in use or isn't a socket")
+        socket_path = None
+    if socket_path:
+        print(f"Starting API server on {socket_path} or {host}:{port} ...")
+        env["SOCKET_PATH"] = socket_path
+    else:
+        print(f"Starting API server on {host}:{port} ...")
+    # A server already listening, such as one left behind by a proxy process that
+    # was killed, would be taken for the new one
+    if _is_listening(socket.AF_INET, (host, port)):
+        raise RuntimeError(f"Port {port} is already in use")
+    notify_path = os.path.join(
+        tempfile.gettempdir(), f"proxy-notify-{os.getpid()}-{port}.sock"
+    )
+    if os.path.exists(notify_path):
+        os.unlink(notify_path)
+    notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify_socket.bind(notify_path)
+    env["NOTIFY_SOCKET"] = notify_path
+
+    try:
+        start_time = time.monotonic()
+        end_time = start_time + start_timeout
+        if zygote:
+            process = zygote.fork(env)
+        else:
+            process = ShellProcess(
+                command,
+                shell=True,
+                env=env,
+                stdin=None,
+                text=True,
+                start_new_session=True,
             )
-        elif method not in accepted_methods:
-            response_body = b"Bad Request"
-            return (
-                401,
-                {
-                    "Content-Length": [str(len(response_body))],
-                    "Content-Type": ["text/plain"],
-                },
-                response_body,
+            if _api_process_groups_path:
+                with open(_api_process_groups_path, "a") as file:
+                    file.write(f"{process.pid}\n")
+        poll_interval = 0.0005
+        while True:
+            # Wait for a notification, which doubles as the interval between polls
+            readable, _, _ = select.select([notify_socket], [], [], poll_interval)
+            notified = readable and b"READY=1" in notify_socket.recv(4096).split()
+            # Check if socket or port is open
+            if socket_path and _is_listening(socket.AF_UNIX, socket_path):
+                listening_path = socket_path
+                break
+            if notified or _is_listening(socket.AF_INET, (host, port)):
+                listening_path = None
+                break
+            if process.poll() is not None:
+                raise RuntimeError(
+                    f"API server exited during start with code {process.returncode}"
+                )
+            if time.monotonic() >= end_time:
+                process.terminate()
+                raise RuntimeError("Timeout waiting for API server to start")
+            poll_interval = min(poll_interval * 2, 0.05)
+    finally:
+        notify_socket.close()
+        os.unlink(notify_path)
+
+    ready_time = time.monotonic() - start_time
+    print(
+        f"API server started on {listening_path or f'{host}:{port}'} "
+        f"in {ready_time * 1000:.1f}ms"
+    )
+    return ApiServer(process=process, socket_path=listening_path, ready_time=ready_time)
+
+
+class ApiWorker:
+    """API server process, started on demand, and its pool of connections"""
+
+    def __init__(
+        self,
+        command: str,
+        host: str,
+        port: int,
+        start_timeout: int,
+        path: str,
+        socket_path: Optional[str] = None,
+        zygote: Optional["Zygote"] = None,
+    ):
+        self.command = command
+        self.host = host
+        self.port = port
+        self.start_timeout = start_timeout
+        self.path = path
+        self.socket_path = socket_path
+        self.zygote = zygote
+        self.server = None  # type: Optional[ApiServer]
+        self.connection_pool = None  # type: Optional[HTTPConnectionPool]
+        # Number of requests being handled, maintained by ApiWorkerPool
+        self.in_flight = 0
+        # Number of times the API server has been restarted, and the number of
+        # those in a row where it failed soon after starting
+        self.restarts = 0
+        self.failures = 0
+        self.started_at = 0.0
+        self.exited = False
+        # Resolved with the connection pool once the API server is ready
+        self.ready = concurrent.futures.Future()
+        self._start_lock = threading.Lock()
+        self._starting = False
+
+    def start(self):
+        """Starts the API server and waits until it's ready, unless already started"""
+        with self._start_lock:
+            if self._starting:
+                return
+            self._starting = True
+        self._start(self.ready)
+
+    def start_in_background(self):
+        """Starts the API server on a background thread, unless already started"""
+        if not self._starting:
+            threading.Thread(target=self.start, name="api-start", daemon=True).start()
+
+    def restart_in_background(self, delay: float):
+        """Terminates the API server, and starts it again after `delay` seconds on a
+        background thread, unless it is already starting"""
+        with self._start_lock:
+            if not self.ready.done():
+                return
+            self.terminate()
+            if self.connection_pool:
+                self.connection_pool.close()
+            self.server = None
+            self.connection_pool = None
+            self.exited = False
+            self.restarts += 1
+            self.ready = ready = concurrent.futures.Future()
+
+        def restart():
+            time.sleep(delay)
+            self._start(ready)
+
+        threading.Thread(target=restart, name="api-restart", daemon=True).start()
+
+    def _start(self, ready: concurrent.futures.Future):
+        try:
+            self.server = start_api_server_process(
+                command=self.command,
+                host=self.host,
+                port=self.port,
+                start_timeout=self.start_timeout,
+                path=self.path,
+                socket_path=self.socket_path,
+                zygote=self.zygote,
             )
-        else:
-            response_body = b"Not Found"
-            return (
-                404,
-                {
-                    "Content-Length": [str(len(response_body))],
-                    "Content-Type": ["text/plain"],
-                },
-                response_body,
+            self.connection_pool = HTTPConnectionPool(
+                host=self.host,
+                port=self.port,
+                socket_path=self.server.socket_path,
+                max_size=API_POOL_SIZE,
+                idle_timeout=API_POOL_IDLE_TIMEOUT,
             )
+        except BaseException as e:
+            self.started_at = time.monotonic()
+            ready.set_exception(e)
+            raise
+        self.started_at = time.monotonic()
+        ready.set_result(self.connection_pool)
 
-    return _root_handler
+    @property
+    def address(self) -> str:
+        if self.server and self.server.socket_path:
+            return self.server.socket_path
+        return f"{self.host}:{self.port}"
 
+    @property
+    def healthy(self) -> bool:
+        """True if the API server is ready and was running when last checked"""
+        return (
+            self.ready.done() and self.ready.exception() is None and not self.exited
+        )
 
-def _is_binary_content(headers: Dict[str, List[str]]) -> bool:
-    """Returns True if the headers indicate binary content"""
-    content_type = "text/plain"
-    content_encoding = "identity"
-    for name, values in headers.items():
-        if name.lower() == "content-type":
-            content_type = values[0]
-        if name.lower() == "content-encoding":
-            content_encoding = values[0]
-    if content_encoding != "identity":
+    def check_failed(self) -> bool:
+        """Returns True if the API server failed to start or has since exited, in
+        which case it's no longer healthy"""
+        if not self.ready.done():
+            return False
+        if self.ready.exception() is None and self.server.process.poll() is None:
+            return False
+        self.exited = True
         return True
-    if _is_text_content_type(content_type):
-        return False
-    return True
 
+    def stats(self) -> Dict:
+        """Returns the health, in-flight requests and connection pool stats"""
+        stats = {
+            "address": self.address,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "restarts": self.restarts,
+            "ready_time": None,
+            "connection_pool": None,
+        }
+        if self.server:
+            stats["ready_time"] = self.server.ready_time
+        if self.connection_pool:
+            stats["connection_pool"] = self.connection_pool.stats()
+        return stats
 
-def _is_text_content_type(content_type: str) -> bool:
-    """Returns True if the Content-Type value indicates text content"""
-    if content_type.startswith("text/"):
-        return True
-    elif content_type.startswith("application/javascript"):
-        return True
-    elif content_type.startswith("application/json"):
-        return True
-    elif content_type.startswith("image/svg+xml"):
-        return True
-    return False
+    def terminate(self):
+        if self.server:
+            self.server.process.terminate()
+
+
+class ApiWorkerPool:
+    """API server workers, which requests are routed between by picking the
+    healthy worker with the fewest requests in flight
+
+    Workers are supervised by checking on the request path whether their process
+    has exited, at most every `check_interval` seconds. Exited workers are replaced
+    by the standby worker if there is one, which takes milliseconds, and are
+    restarted with exponential backoff if they keep failing.
+    """
+
+    def __init__(
+        self,
+        workers: List[ApiWorker],
+        standby: Optional[ApiWorker] = None,
+        check_interval: float = 0.5,
+        restart_backoff: float = 0.1,
+        restart_backoff_max: float = 10,
+    ):
+        self.workers = workers
+        self.standby = standby
+        self.check_interval = check_interval
+        self.restart_backoff = restart_backoff
+        self.restart_backoff_max = restart_backoff_max
+        self._last_check = time.monotonic()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts all workers in parallel, and waits until the first is ready, while
+        the rest carry on starting in the background"""
+        self.start_in_background()
+        pending = {worker.ready for worker in self.workers}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            if any(future.exception() is None for future in done):
+                return
+        # None of the workers started, so raise the first's error
+        self.workers[0].ready.result()
+
+    def start_in_background(self):
+        for worker in self._all_workers():
+            worker.start_in_background()
+
+    def acquire(self, timeout: float) -> Tuple[ApiWorker, "HTTPConnectionPool"]:
+        """Picks a worker for a request, starting the workers if needed, and waiting
+        up to `timeout` for one to be ready; must be followed by `release`
+
+        The worker's connection pool is returned with it, as a worker that's
+        restarted meanwhile replaces its own.
+        """
+        self.start_in_background()
+        now = time.monotonic()
+        deadline = now + timeout
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            self.check()
+        while True:
+            with self._lock:
+                healthy = [worker for worker in self.workers if worker.healthy]
+                if healthy:
+                    worker = min(healthy, key=lambda worker: worker.in_flight)
+                    worker.in_flight += 1
+                    return worker, worker.connection_pool
+            starting = [w.ready for w in self.workers if not w.ready.done()]
+            if not starting:
+                # Workers that failed to start are restarted by a check
+                self.check()
+                starting = [w.ready for w in self.workers if not w.ready.done()]
+            if not starting:
+                raise RuntimeError("No API server workers are running")
+            concurrent.futures.wait(
+                starting,
+                timeout=max(deadline - time.monotonic(), 0),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if time.monotonic() >= deadline:
+                raise concurrent.futures.TimeoutError()
+
+    def release(self, worker: ApiWorker):
+        """Records that a request acquired from the pool has finished"""
+        with self._lock:
+            worker.in_flight -= 1
+
+    def check(self, worker: Optional[ApiWorker] = None):
+        """Checks whether workers have exited, or just `worker` if given, and
+        replaces or restarts those that have"""
+        with self._lock:
+            for index, each in enumerate(self.workers):
+                if (worker is None or each is worker) and each.check_failed():
+                    self._replace(index)
+            if self.standby and self.standby.check_failed():
+                self._restart(self.standby)
+
+    def _replace(self, index: int):
+        worker = self.workers[index]
+        print(f"API server on {worker.address} has exited")
+        if self.standby and self.standby.healthy:
+            print(f"Failing over to standby API server on {self.standby.address}")
+            self.workers[index], self.standby = self.standby, worker
+        self._restart(worker)
+
+    def _restart(self, worker: ApiWorker):
+        # Back off when the API server keeps failing soon after starting
+        if time.monotonic() - worker.started_at >= 30:
+            worker.failures = 0
+        if worker.failures:
+            delay = min(
+                self.restart_backoff * 2 ** (worker.failures - 1),
+                self.restart_backoff_max,
+            )
+        else:
+            delay = 0
+        worker.failures += 1
+        print(f"Restarting API server on {worker.address} in {delay:.1f}s ...")
+        worker.restart_in_background(delay=delay)
+
+    def stats(self) -> Dict:
+        return {
+            "workers": [worker.stats() for worker in self.workers],
+            "standby": self.standby.stats() if self.standby else None,
+        }
+
+    def terminate(self):
+        for worker in self._all_workers():
+            worker.terminate()
 
+    def _all_workers(self) -> List[ApiWorker]:
+        return self.workers + ([self.standby] if self.standby else [])
+
+
+class Overloaded(Exception):
+    """Raised when a request is rejected by admission control"""
+
+
+class AdmissionController:
+    """Limits the number of requests in flight to a backend, queueing those beyond
+    the limit in order for up to `max_queue_time`, and rejecting requests at once
+    when `max_queue` are already waiting
+
+    Requests are admitted from threads with `acquire`, or from an event loop with
+    `acquire_async`, and each must be followed by `release`, which hands its slot
+    over to the next request in the queue.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        max_queue: int,
+        max_queue_time: float,
+        retry_after: int = 1,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._waiters = deque()  # type: deque
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float):
+        """Admits a request, waiting in the queue for up to `timeout` or
+        `max_queue_time` if the backend is at its limit, or raises Overloaded"""
+        event = threading.Event()
+        waiter = self._enqueue(event.set)
+        if waiter is None:
+            return
+        event.wait(max(min(timeout, self.max_queue_time), 0))
+        self._dequeue(waiter)
+
+    async def acquire_async(self, timeout: float):
+        """Admits a request like `acquire`, waiting without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(_wake)
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait(
+                [future], timeout=max(min(timeout, self.max_queue_time), 0)
+            )
+        except asyncio.CancelledError:
+            # The client went away, so give up the place or slot
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    waiter = None
+            if waiter is not None:
+                self.release()
+            raise
+        self._dequeue(waiter)
+
+    def release(self):
+        """Records that an admitted request has finished"""
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft()()
+            else:
+                self.in_flight -= 1
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+    def _enqueue(self, wake: Callable[[], None]) -> Optional[Callable[[], None]]:
+        """Admits a request at once and returns None if the backend is below its
+        limit, or otherwise queues it, returning its place in the queue"""
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._waiters:
+                self.in_flight += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded()
+            self._waiters.append(wake)
+            return wake
+
+    def _dequeue(self, waiter: Callable[[], None]):
+        """Removes a request from the queue after it has waited, and raises
+        Overloaded if it wasn't admitted in time"""
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self.timed_out += 1
+                raise Overloaded()
+
+
+class ApiServer(NamedTuple):
+    """API server process that has started and is ready to accept requests"""
+
+    process: Union["ShellProcess", "ZygoteProcess"]
+    # Unix domain socket path the API server is listening on, or None for TCP
+    socket_path: Optional[str]
+    # Time taken from starting the process until it was ready, in seconds
+    ready_time: float
+
+
+class ShellProcess(subprocess.Popen):
+    """Process running a shell command in a new session, which terminates the whole
+    process group so that the shell's children are terminated with it"""
+
+    def terminate(self):
+        try:
+            os.killpg(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+class Zygote:
+    """Template interpreter that imports the API server script once, then forks
+    ready-to-serve API server processes from it on demand
+
+    If the zygote exits, such as by being killed when out of memory, it's started
+    again by the next fork.
+    """
+
+    def __init__(self, command: str, path: str):
+        args = shlex.split(command)
+        if len(args) < 2 or not os.path.basename(args[0]).startswith("python"):
+            raise ValueError(f"Zygote needs a `python <script>` command: {command}")
+        self.args = args
+        self.path = path
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        print(f"Starting API server zygote for {self.args[1]} ...")
+        reply_fd, reply_write_fd = os.pipe()
+        self.process = subprocess.Popen(
+            [self.args[0], "-c", _ZYGOTE_SOURCE, str(reply_write_fd), *self.args[1:]],
+            env={"PATH": self.path, "PYTHONPATH": ".pypath/"},
+            stdin=subprocess.PIPE,
+            pass_fds=(reply_write_fd,),
+        )
+        os.close(reply_write_fd)
+        self._replies = os.fdopen(reply_fd, "rb")
+
+    def fork(self, env: Dict[str, str]) -> "ZygoteProcess":
+        """Forks a new API server process, with the given environment"""
+        with self._lock:
+            if self.process.poll() is not None:
+                print(
+                    f"API server zygote exited with code {self.process.returncode}, "
+                    "restarting it ..."
+                )
+                self.process.stdin.close()
+                self._replies.close()
+                self.restarts += 1
+                self._start()
+            try:
+                self.process.stdin.write(json.dumps(env).encode("utf-8") + b"\n")
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                pass
+            reply = self._replies.readline()
+        if not reply:
+            raise RuntimeError(
+                f"API server zygote exited with code {self.process.poll()}"
+            )
+        return ZygoteProcess(int(reply))
+
+    def terminate(self):
+        self.process.terminate()
+
+
+class ZygoteProcess:
+    """Process forked by the zygote, with the parts of the subprocess.Popen
+    interface used for API server processes"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.returncode = None  # type: Optional[int]
+
+    def poll(self) -> Optional[int]:
+        # The zygote reaps its children, so the exit code isn't available
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self.returncode = -1
+        return self.returncode
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+# Program run by the zygote interpreter, with the arguments: reply fd, script,
+# script arguments. Each line read from stdin is the JSON environment for a new
+# process, and the process ID is written as a line to the reply fd.
+_ZYGOTE_SOURCE = """
+import json, os, runpy, signal, sys, traceback
+
+reply_fd = int(sys.argv[1])
+script = sys.argv[2]
+sys.argv = sys.argv[2:]
+sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+
+# Import the script and its dependencies, without running it as __main__
+runpy.run_path(script, run_name="__zygote__")
+
+# Let forked processes be reaped automatically
+signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+for line in sys.stdin:
+    env = json.loads(line)
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os.close(reply_fd)
+            os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+            os.environ.clear()
+            os.environ.update(env)
+            runpy.run_path(script, run_name="__main__")
+            exit_code = 0
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+    os.write(reply_fd, b"%d\\n" % pid)
+"""
+
+
+def _is_listening(family: int, address) -> bool:
+    """Returns True if a server is accepting connections at the address"""
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        return sock.connect_ex(address) == 0
+
+
+def _remove_stale_socket(socket_path: str) -> bool:
+    """Removes a socket left behind by a previous API server, and returns whether
+    the path is free to use; a file that isn't a socket, or a socket that a server
+    is accepting connections on, is left in place"""
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return True
+    if not stat.S_ISSOCK(mode) or _is_listening(socket.AF_UNIX, socket_path):
+        return False
+    os.unlink(socket_path)
+    return True
+
+
+def load_app(spec: str) -> Callable:
+    """Imports an application given as `module:attribute`, such as `api.app:app`"""
+    module_name, _, attribute = spec.partition(":")
+    # The API server's dependencies are installed to .pypath/
+    if ".pypath/" not in sys.path:
+        sys.path.insert(0, ".pypath/")
+    module = importlib.import_module(module_name)
+    return getattr(module, attribute or "app")
+
+
+def start_event_loop() -> asyncio.AbstractEventLoop:
+    """Starts an asyncio event loop running on a background thread"""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="event-loop", daemon=True)
+    thread.start()
+    return loop
+
+
+class AsgiRunner:
+    """Runs an ASGI application on an event loop, from any thread"""
+
+    def __init__(self, app: Callable, loop: asyncio.AbstractEventLoop):
+        self.app = app
+        self.loop = loop
+        # Lifespan state, which is copied into the scope of each request
+        self.state = {}
+        self.lifespan_supported = True
+        self._lifespan_events = None
+        self._lifespan_futures = {}
+
+    def startup(self, timeout: float):
+        """Runs the lifespan startup of the application"""
+        self._run(self._lifespan("startup"), timeout=timeout)
+
+    def shutdown(self, timeout: float):
+        """Runs the lifespan shutdown of the application"""
+        if self.lifespan_supported:
+            self._run(self._lifespan("shutdown"), timeout=timeout)
+
+    def call(
+        self, scope: Dict, body: bytes, timeout: float
+    ) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+        """Calls the application with an HTTP request, returning the response"""
+        return self._run(self._http(scope, body), timeout=timeout)
+
+    def _run(self, coroutine, timeout: float):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    async def _lifespan(self, event: str):
+        if self._lifespan_events is None:
+            self._lifespan_events = asyncio.Queue()
+            self._lifespan_futures = {
+                "startup": self.loop.create_future(),
+                "shutdown": self.loop.create_future(),
+            }
+            self.loop.create_task(self._lifespan_main())
+        await self._lifespan_events.put({"type": f"lifespan.{event}"})
+        await self._lifespan_futures[event]
+
+    async def _lifespan_main(self):
+        scope = {
+            "type": "lifespan",
+            "asgi": {"version": "3.0", "spec_version": "2.0"},
+            "state": self.state,
+        }
+
+        async def send(message: Dict):
+            _, event, result = message["type"].split(".")
+            if result == "failed":
+                error = RuntimeError(f"ASGI lifespan {event} failed: {message}")
+                self._lifespan_futures[event].set_exception(error)
+            else:
+                self._lifespan_futures[event].set_result(None)
+
+        try:
+            await self.app(scope, self._lifespan_events.get, send)
+        except Exception as e:
+            # Applications that don't support lifespan raise an exception
+            if not self._lifespan_futures["startup"].done():
+                print(f"ASGI lifespan not supported: {e!r}")
+                self.lifespan_supported = False
+        finally:
+            for future in self._lifespan_futures.values():
+                if not future.done():
+                    future.set_result(None)
+
+    async def _http(
+        self, scope: Dict, body: bytes
+    ) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+        response_start = {}
+        response_chunks = []
+        request_sent = False
+        response_complete = asyncio.Event()
+
+        async def receive() -> Dict:
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await response_complete.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: Dict):
+            if message["type"] == "http.response.start":
+                response_start.update(message)
+            elif message["type"] == "http.response.body":
+                response_chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    response_complete.set()
+
+        try:
+            await self.app(dict(scope, state=dict(self.state)), receive, send)
+        finally:
+            response_complete.set()
+        if not response_start:
+            raise RuntimeError("ASGI application returned without a response")
+        return (
+            response_start["status"],
+            response_start.get("headers", []),
+            b"".join(response_chunks),
+        )
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTPConnection to a server listening on a Unix domain socket"""
+
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class HTTPConnectionPool:
+    """Bounded, thread-safe pool of persistent HTTP/1.1 connections to one server"""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        max_size: int,
+        idle_timeout: float,
+        socket_path: Optional[str] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self._idle = []  # type: List[Tuple[HTTPConnection, float]]
+        # Idle connections opened on an event loop, as asyncio streams, with the
+        # event loop and the time since they've been idle
+        self._idle_streams = []  # type: List[Tuple]
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self, timeout: float) -> Tuple[HTTPConnection, bool]:
+        """Returns a connection, and whether it was reused from the pool"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    self.misses += 1
+                    break
+                connection, idle_since = self._idle.pop()
+            if (
+                time.monotonic() - idle_since < self.idle_timeout
+                and not _is_connection_dropped(connection)
+            ):
+                with self._lock:
+                    self.hits += 1
+                connection.timeout = timeout
+                connection.sock.settimeout(timeout)
+                return connection, True
+            connection.close()
+            with self._lock:
+                self.discarded += 1
+        if self.socket_path:
+            return UnixHTTPConnection(self.socket_path, timeout=timeout), False
+        return HTTPConnection(self.host, self.port, timeout=timeout), False
+
+    def release(self, connection: HTTPConnection, reusable: bool):
+        """Returns a connection to the pool once its response has been fully read"""
+        if reusable and connection.sock is not None:
+            with self._lock:
+                if self._has_room():
+                    self._idle.append((connection, time.monotonic()))
+                    return
+        connection.close()
+
+    def acquire_stream(
+        self,
+    ) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+        """Returns an idle connection opened on an event loop, or None if there
+        isn't one, in which case the caller opens a new one"""
+        while True:
+            with self._lock:
+                if not self._idle_streams:
+                    self.misses += 1
+                    return None
+                reader, writer, _, idle_since = self._idle_streams.pop()
+            if (
+                time.monotonic() - idle_since < self.idle_timeout
+                and not reader.at_eof()
+            ):
+                with self._lock:
+                    self.hits += 1
+                return reader, writer
+            writer.close()
+            with self._lock:
+                self.discarded += 1
+
+    def release_stream(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, reusable: bool
+    ):
+        """Returns a connection opened on the running event loop to the pool once
+        its response has been fully read"""
+        if reusable:
+            loop = asyncio.get_running_loop()
+            with self._lock:
+                if self._has_room():
+                    self._idle_streams.append((reader, writer, loop, time.monotonic()))
+                    return
+        writer.close()
+
+    def _has_room(self) -> bool:
+        """Returns whether a released connection can be kept; must hold the lock"""
+        return (
+            not self._closed
+            and len(self._idle) + len(self._idle_streams) < self.max_size
+        )
+
+    def close(self):
+        """Closes all idle connections, and those released from now on"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            idle_streams, self._idle_streams = self._idle_streams, []
+        for connection, _ in idle:
+            connection.close()
+        for _, writer, loop, _ in idle_streams:
+            # Streams can only be closed on their own event loop
+            try:
+                loop.call_soon_threadsafe(writer.close)
+            except RuntimeError:
+                pass  # The event loop is closed
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the pool size and hit/miss counters"""
+        with self._lock:
+            return {
+                "size": len(self._idle) + len(self._idle_streams),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "discarded": self.discarded,
+            }
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache, bounded by the total size of values"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value for the key, or None if it's not in the cache"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int):
+        """Adds a value to the cache, evicting the least recently used values to
+        make space, unless the value is larger than the whole cache"""
+        if size > self.max_size:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# Static files that are entrypoints to the web application, which must be
+# revalidated on each use so that new deployments are picked up
+_STATIC_NO_CACHE_FILENAMES = frozenset(("index.html", "service-worker.js"))
+
+_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class RequestBodyTooLarge(Exception):
+    """Raised when a request body is read past the maximum size allowed"""
+
+
+class RequestStream:
+    """Request body read from a client in chunks, as it's sent to the API server"""
+
+    def __init__(self, file: io.BufferedIOBase, length: Optional[int], max_size: int):
+        # The body is in chunked transfer encoding if its length isn't given
+        self.file = file
+        self.length = length
+        self.max_size = max_size
+        self.started = False
+        self.finished = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        self.started = True
+        size = 0
+        for chunk in self._read_chunks():
+            size += len(chunk)
+            if size > self.max_size:
+                raise RequestBodyTooLarge()
+            yield chunk
+        self.finished = True
+
+    def _read_chunks(self) -> Iterator[bytes]:
+        if self.length is not None:
+            remaining = self.length
+            while remaining:
+                chunk = self.file.read(min(remaining, _STREAM_CHUNK_SIZE))
+                if not chunk:
+                    raise ConnectionResetError("Request body ended early")
+                remaining -= len(chunk)
+                yield chunk
+            return
+        while True:
+            size_line = self.file.readline(1024)
+            if not size_line.endswith(b"\n"):
+                raise ConnectionResetError("Request body ended early")
+            size = int(size_line.split(b";", 1)[0], 16)
+            if not size:
+                break
+            # Chunks are relayed in pieces, so large chunks don't spike memory
+            while size:
+                data = self.file.read(min(size, _STREAM_CHUNK_SIZE))
+                if not data:
+                    raise ConnectionResetError("Request body ended early")
+                size -= len(data)
+                yield data
+            self.file.readline(1024)
+        # Skip any trailer fields
+        while self.file.readline(1024).strip():
+            pass
+
+    def read(self) -> bytes:
+        """Reads the whole body into memory"""
+        return b"".join(self)
+
+
+class ResponseStream:
+    """Response body relayed in chunks as they're received, which must be closed"""
+
+    def __init__(self, chunks: Iterator[bytes], on_close: Callable[[], None]):
+        self._chunks = chunks
+        self._on_close = [on_close]
+        self._closed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self._chunks
+
+    def add_close_callback(self, callback: Callable[[], None]):
+        """Adds a function to call once the body has been relayed, or abandoned"""
+        self._on_close.append(callback)
+
+    def read(self) -> bytes:
+        """Reads the rest of the body into memory, and closes it"""
+        try:
+            return b"".join(self._chunks)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for callback in self._on_close:
+            callback()
+
+
+class AsyncResponseStream:
+    """Response body relayed in chunks as they're received by an event loop, which
+    must be closed"""
+
+    def __init__(self, chunks: AsyncIterator[bytes], on_close: Callable[[], None]):
+        self._chunks = chunks
+        self._on_close = [on_close]
+        self._closed = False
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._chunks
+
+    def add_close_callback(self, callback: Callable[[], None]):
+        """Adds a function to call once the body has been relayed, or abandoned"""
+        self._on_close.append(callback)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for callback in self._on_close:
+            callback()
+
+
+class ResponseCompressor:
+    """Compresses large text responses with gzip or deflate, as accepted by the
+    client, caching the compressed form of identical bodies"""
+
+    def __init__(self, level: int, min_size: int, cache_size: int):
+        self.level = level
+        self.min_size = min_size
+        self.cache = LRUCache(max_size=cache_size)
+
+    def compress(
+        self,
+        status: int,
+        headers: Dict[str, List[str]],
+        body: Union[bytes, ResponseStream, AsyncResponseStream, None],
+        accept_encoding: Optional[str],
+    ) -> Tuple[
+        int,
+        Dict[str, List[str]],
+        Union[bytes, ResponseStream, AsyncResponseStream, None],
+    ]:
+        """Compresses a response body if it's large text the client can decode"""
+        if isinstance(body, (ResponseStream, AsyncResponseStream)):
+            # The length of a stream is unknown if it's sent in chunks
+            content_length = _get_header(headers, "Content-Length")
+            length = int(content_length) if content_length else None
+        else:
+            length = len(body or b"")
+        if length == 0 or (length is not None and length < self.min_size):
+            return status, headers, body
+        content_type = _get_header(headers, "Content-Type") or ""
+        cache_control = _get_header(headers, "Cache-Control") or ""
+        # Partial responses are ranges of the uncompressed body, so are left as is
+        if (
+            not _is_text_content_type(content_type)
+            or _get_header(headers, "Content-Encoding") is not None
+            or _get_header(headers, "Content-Range") is not None
+            or status == 206
+            or "no-transform" in cache_control.lower()
+        ):
+            return status, headers, body
+        qualities = _parse_accept_encoding(accept_encoding or "")
+        content_encoding = max(
+            ("gzip", "deflate"),
+            key=lambda coding: qualities.get(coding, qualities.get("*", 0.0)),
+        )
+        if qualities.get(content_encoding, qualities.get("*", 0.0)) <= 0:
+            return status, headers, body
+
+        if isinstance(body, (ResponseStream, AsyncResponseStream)):
+            compressor = zlib.compressobj(
+                self.level,
+                zlib.DEFLATED,
+                # Window size with a gzip or zlib header and trailer
+                31 if content_encoding == "gzip" else 15,
+            )
+            if isinstance(body, ResponseStream):
+                compressed_body = ResponseStream(
+                    _compress_chunks(body, compressor), on_close=body.close
+                )
+            else:
+                compressed_body = AsyncResponseStream(
+                    _compress_chunks_async(body, compressor), on_close=body.close
+                )
+            return (
+                status,
+                _get_compressed_headers(headers, content_encoding, None),
+                compressed_body,
+            )
+
+        # Identical responses, such as for popular resources, are compressed once
+        key = (content_encoding, hashlib.sha256(body).digest())
+        compressed_body = self.cache.get(key)
+        if compressed_body is None:
+            if content_encoding == "gzip":
+                compressed_body = gzip.compress(body, compresslevel=self.level, mtime=0)
+            else:
+                compressed_body = zlib.compress(body, self.level)
+            self.cache.put(key, compressed_body, size=len(compressed_body))
+        if len(compressed_body) >= len(body):
+            return status, headers, body
+        return (
+            status,
+            _get_compressed_headers(headers, content_encoding, len(compressed_body)),
+            compressed_body,
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return self.cache.stats()
+
+
+class FileBody(NamedTuple):
+    """Response body to be sent from part of a file, rather than from memory"""
+
+    path: str
+    offset: int
+    length: int
+
+    def read(self) -> bytes:
+        """Reads the part of the file into memory"""
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            return file.read(self.length)
+
+
+class StaticAsset(NamedTuple):
+    """Static file metadata, as listed in the static asset manifest"""
+
+    # Path of the file, relative to the static path
+    filename: str
+    size: int
+    # Modification time of the file, in nanoseconds
+    mtime_ns: int
+    content_type: str
+    # Validators for conditional requests, derived from the content and mtime
+    etag: str
+    last_modified: str
+    # Sizes of precompressed variants of the file, by content coding
+    encodings: Dict[str, int]
+
+
+# File suffixes of precompressed variants of static files, by content coding
+_STATIC_ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def build_static_manifest(static_path: str) -> Dict[str, StaticAsset]:
+    """Builds the manifest of static files, mapping URL paths to their metadata"""
+    root = Path(static_path)
+    filenames = sorted(
+        filepath.relative_to(root).as_posix()
+        for filepath in root.rglob("*")
+        if filepath.is_file()
+    )
+    # Precompressed variants are listed with the file they are a variant of
+    variants = {
+        filename + suffix
+        for filename in filenames
+        for suffix in _STATIC_ENCODING_SUFFIXES.values()
+    }
+    return {
+        "/" + filename: read_static_asset(root, filename)
+        for filename in filenames
+        if filename not in variants
+    }
+
+
+def read_static_asset(root: Path, filename: str) -> StaticAsset:
+    """Reads the metadata of a static file, including its precompressed variants"""
+    filepath = root / filename
+    stat = filepath.stat()
+    encodings = {}
+    for coding, suffix in _STATIC_ENCODING_SUFFIXES.items():
+        variant_path = root / (filename + suffix)
+        if variant_path.is_file():
+            encodings[coding] = variant_path.stat().st_size
+    content_hash = hashlib.sha256(filepath.read_bytes()).hexdigest()
+    return StaticAsset(
+        filename=filename,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        content_type=guess_type(filename)[0] or "text/plain",
+        etag=f'"{content_hash[:32]}"',
+        last_modified=formatdate(stat.st_mtime_ns / 1e9, usegmt=True),
+        encodings=encodings,
+    )
+
+
+def _get_cache_control(
+    asset: StaticAsset, default: str, immutable_pattern: Pattern
+) -> str:
+    """Returns the Cache-Control policy for a static file"""
+    if asset.filename.rsplit("/", 1)[-1] in _STATIC_NO_CACHE_FILENAMES:
+        return "no-cache"
+    elif immutable_pattern.search(asset.filename):
+        return _IMMUTABLE_CACHE_CONTROL
+    return default
+
+
+def write_static_manifest(manifest: Dict[str, StaticAsset], filepath: str):
+    """Writes the static asset manifest to a JSON file"""
+    assets = {path: asset._asdict() for path, asset in manifest.items()}
+    Path(filepath).write_text(json.dumps({"version": 1, "assets": assets}, indent=1))
+
+
+def load_static_manifest(filepath: str) -> Dict[str, StaticAsset]:
+    """Loads the static asset manifest from a JSON file"""
+    data = json.loads(Path(filepath).read_text())
+    assert data["version"] == 1
+    return {path: StaticAsset(**asset) for path, asset in data["assets"].items()}
+
+
+def is_static_manifest_current(
+    manifest: Dict[str, StaticAsset], static_path: str
+) -> bool:
+    """Returns whether a manifest lists the files in `static_path` with their current
+    sizes, so wasn't left behind by a previous build; modification times aren't
+    compared, as deployment packages such as zip files round them"""
+    root = Path(static_path)
+    expected = {}
+    for asset in manifest.values():
+        expected[asset.filename] = asset.size
+        for coding, size in asset.encodings.items():
+            expected[asset.filename + _STATIC_ENCODING_SUFFIXES[coding]] = size
+    found = {
+        filepath.relative_to(root).as_posix(): filepath.stat().st_size
+        for filepath in root.rglob("*")
+        if filepath.is_file()
+    }
+    return found == expected
+
+
+def make_proxy_app(
+    static_path: str,
+    static_manifest_path: str = "",
+    static_cache_control: str = "no-cache",
+    static_immutable_pattern: str = "",
+    static_file_bodies: bool = False,
+    static_cache_size: int = 0,
+    dev_mode: bool = False,
+    api_workers: Optional[ApiWorkerPool] = None,
+    api_wsgi_app: Optional[Callable] = None,
+    api_asgi_runner: Optional[AsgiRunner] = None,
+    api_compressor: Optional["ResponseCompressor"] = None,
+    api_admission: Optional[AdmissionController] = None,
+    status_path: str = "",
+) -> Callable:
+    """Builds the proxy server application and returns the root request handler"""
+    static_manifest = None
+    if static_manifest_path and os.path.exists(static_manifest_path) and not dev_mode:
+        static_manifest = load_static_manifest(static_manifest_path)
+        if not is_static_manifest_current(static_manifest, static_path):
+            print(f"Ignoring {static_manifest_path}, as the static files have changed")
+            static_manifest = None
+    if static_manifest is None:
+        static_manifest = build_static_manifest(static_path)
+    immutable_pattern = re.compile(static_immutable_pattern or "(?!)")
+    # The policy is worked out once per file, rather than matched on each request
+    static_cache_controls = {
+        asset.filename: _get_cache_control(
+            asset, static_cache_control, immutable_pattern
+        )
+        for asset in static_manifest.values()
+    }
+    static_cache = LRUCache(max_size=static_cache_size)
+
+    def _root_handler(
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        headers: Dict[str, List[str]],
+        body: Union[bytes, RequestStream, None],
+        timeout: float,
+    ) -> Tuple[int, Dict[str, List[str]], Union[bytes, FileBody, ResponseStream, None]]:
+        """Root request handler"""
+        if path == "/":
+            return _static_handler(method=method, path="/index.html", headers=headers)
+        elif status_path and path == status_path:
+            return _status_handler()
+        elif path.startswith("/api/"):
+            deadline = time.monotonic() + timeout
+            if api_admission is not None:
+                try:
+                    api_admission.acquire(timeout=timeout)
+                except Overloaded:
+                    return _overloaded_response(api_admission.retry_after)
+            try:
+                response = _api_handler(
+                    method=method,
+                    path=path,
+                    query=query,
+                    headers=headers,
+                    body=body,
+                    timeout=deadline - time.monotonic(),
+                )
+            except RequestBodyTooLarge:
+                if api_admission is not None:
+                    api_admission.release()
+                return _text_response(413, "Payload Too Large")
+            except BaseException:
+                if api_admission is not None:
+                    api_admission.release()
+                raise
+            if api_admission is not None:
+                if isinstance(response[2], ResponseStream):
+                    response[2].add_close_callback(api_admission.release)
+                else:
+                    api_admission.release()
+            if api_compressor is not None:
+                response = api_compressor.compress(
+                    *response, accept_encoding=_get_header(headers, "Accept-Encoding")
+                )
+            return response
+        else:
+            return _static_handler(method=method, path=path, headers=headers)
+
+    def _api_handler(
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        headers: Dict[str, List[str]],
+        body: Union[bytes, RequestStream, None],
+        timeout: float,
+    ) -> Tuple[int, Dict[str, List[str]], Union[bytes, ResponseStream]]:
+        """Resolves API requests, in-process or by proxying to the API server"""
+        if api_asgi_runner is None and api_wsgi_app is None:
+            return _api_server_handler(
+                method=method,
+                path=path,
+                query=query,
+                headers=headers,
+                body=body,
+                timeout=timeout,
+            )
+        # Applications called in-process are given the whole request body
+        if isinstance(body, RequestStream):
+            body = body.read()
+        if api_asgi_runner is not None:
+            return _asgi_handler(
+                method=method,
+                path=path,
+                query=query,
+                headers=headers,
+                body=body,
+                timeout=timeout,
+            )
+        else:
+            return _wsgi_handler(
+                method=method, path=path, query=query, headers=headers, body=body,
+            )
+
+    def _api_server_handler(
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        headers: Dict[str, List[str]],
+        body: Union[bytes, RequestStream, None],
+        timeout: float,
+    ) -> Tuple[int, Dict[str, List[str]], Union[bytes, ResponseStream]]:
+        """Resolves requests by proxying to the API server"""
+        deadline = time.monotonic() + timeout
+        for attempt in range(2):
+            try:
+                worker, connection_pool = api_workers.acquire(
+                    timeout=deadline - time.monotonic()
+                )
+            except concurrent.futures.TimeoutError:
+                return _text_response(503, "Service Unavailable")
+            try:
+                status, response_headers, response_body = _api_server_request(
+                    api_connection_pool=connection_pool,
+                    method=method,
+                    path=path,
+                    query=query,
+                    headers=headers,
+                    body=body,
+                    timeout=deadline - time.monotonic(),
+                )
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The API server may have exited, so have it checked now, and as
+                # the request wasn't sent, retry it once
+                api_workers.check(worker)
+                api_workers.release(worker)
+                if attempt:
+                    return _text_response(503, "Service Unavailable")
+                continue
+            except BaseException:
+                api_workers.release(worker)
+                raise
+            if isinstance(response_body, ResponseStream):
+                # The API server is busy with the request until the body is relayed
+                response_body.add_close_callback(lambda: api_workers.release(worker))
+            else:
+                api_workers.release(worker)
+            return status, response_headers, response_body
+
+    def _api_server_request(
+        api_connection_pool: HTTPConnectionPool,
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        headers: Dict[str, List[str]],
+        body: Union[bytes, RequestStream, None],
+        timeout: float,
+    ) -> Tuple[int, Dict[str, List[str]], Union[bytes, ResponseStream]]:
+        """Sends a request to an API server, using a connection from its pool"""
+        url = path
+        if len(query):
+            url += "?" + urlencode(query, doseq=True)
+        # Build a dict-like that supports multiple values per key
+        headers_multi = Message()
+        for name, values in headers.items():
+            if name.lower() in _HOP_BY_HOP_HEADERS:
+                continue
+            for value in values:
+                headers_multi.add_header(name, value)
+        # Streamed bodies are sent as iterables, in chunked transfer encoding if
+        # their length isn't known
+        request_body = iter(body) if isinstance(body, RequestStream) else body
+
+        connection, reused = api_connection_pool.acquire(timeout=timeout)
+        try:
+            sent = False
+            try:
+                connection.request(
+                    method=method, url=url, headers=headers_multi, body=request_body,
+                )
+                sent = True
+                response = connection.getresponse()
+            except (BrokenPipeError, ConnectionResetError, RemoteDisconnected):
+                # A streamed request body can't be sent again once it's been read,
+                # and a request that was sent may have been acted on already
+                if (
+                    not reused
+                    or (isinstance(body, RequestStream) and body.started)
+                    or (sent and method.upper() not in _IDEMPOTENT_METHODS)
+                ):
+                    raise
+                # The API server closed the idle connection as it was being
+                # reused, so retry once on a new connection
+                connection.close()
+                connection.request(
+                    method=method, url=url, headers=headers_multi, body=request_body,
+                )
+                response = connection.getresponse()
+            if response.length is not None and response.length <= _STREAM_CHUNK_SIZE:
+                response_body = response.read()
+            else:
+                response_body = None
+        except BaseException:
+            connection.close()
+            raise
+        if response_body is not None:
+            api_connection_pool.release(connection, reusable=not response.will_close)
+        else:
+            # Relay large or chunked responses as they're received, and only reuse
+            # the connection if the response is read to the end
+            def _close():
+                if response.isclosed():
+                    api_connection_pool.release(
+                        connection, reusable=not response.will_close
+                    )
+                else:
+                    connection.close()
+
+            response_body = ResponseStream(_read_chunks(response), on_close=_close)
+
+        status = response.status
+        response_headers = {}
+        for name, value in response.getheaders():
+            if name.lower() in _HOP_BY_HOP_HEADERS:
+                continue
+            if name in response_headers:
+                response_headers[name].append(value)
+            else:
+                response_headers[name] = [value]
+        return status, response_headers, response_body
+
+    def _status_handler() -> Tuple[int, Dict[str, List[str]], Optional[bytes]]:
+        """Returns the status of the proxy, such as the health of API workers"""
+        status = {
+            "api_workers": api_workers.stats() if api_workers else None,
+            "static_cache": static_cache.stats(),
+            "compress_cache": api_compressor.stats() if api_compressor else None,
+            "api_admission": api_admission.stats() if api_admission else None,
+        }
+        response_body = json.dumps(status).encode("utf-8")
+        return (
+            200,
+            {
+                "Content-Length": [str(len(response_body))],
+                "Content-Type": ["application/json"],
+                "Cache-Control": ["no-store"],
+            },
+            response_body,
+        )
+
+    def _wsgi_handler(
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        headers: Dict[str, List[str]],
+        body: Optional[bytes],
+    ) -> Tuple[int, Dict[str, List[str]], Union[bytes, ResponseStream]]:
+        """Resolves requests by calling the WSGI application in-process, streaming
+        the response if it's large or of unknown length"""
+        environ = _make_wsgi_environ(
+            method=method, path=path, query=query, headers=headers, body=body,
+        )
+        response_start = []
+        response_chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response_start:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response_start[:] = [status, headers]
+            return response_chunks.append
+
+        result = api_wsgi_app(environ, start_response)
+        close = result.close if hasattr(result, "close") else lambda: None
+        try:
+            # The application may only start the response once it yields the first
+            # chunk of the body
+            chunks = iter(result)
+            finished = True
+            for chunk in chunks:
+                response_chunks.append(chunk)
+                if chunk:
+                    finished = False
+                    break
+
+            status_line, header_list = response_start
+            status = int(status_line.split(" ", 1)[0])
+            response_headers = {}
+            for name, value in header_list:
+                if name in response_headers:
+                    response_headers[name].append(value)
+                else:
+                    response_headers[name] = [value]
+            length = _get_header(response_headers, "Content-Length")
+            if not finished and (length is None or int(length) > _STREAM_CHUNK_SIZE):
+                # Relay the rest of the body as the application yields it
+                response_body = ResponseStream(
+                    itertools.chain(response_chunks, chunks), on_close=close
+                )
+                return status, response_headers, response_body
+            response_chunks.extend(chunks)
+        except BaseException:
+            close()
+            raise
+        close()
+        return status, response_headers, b"".join(response_chunks)
+
+    def _asgi_handler(
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        headers: Dict[str, List[str]],
+        body: Optional[bytes],
+        timeout: float,
+    ) -> Tuple[int, Dict[str, List[str]], Optional[bytes]]:
+        """Resolves requests by calling the ASGI application in-process"""
+        if body is None:
+            body = b""
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+        scope = _make_asgi_scope(method=method, path=path, query=query, headers=headers)
+        try:
+            status, header_list, response_body = api_asgi_runner.call(
+                scope, body, timeout=timeout
+            )
+        except concurrent.futures.TimeoutError:
+            return _text_response(504, "Gateway Timeout")
+        response_headers = {}
+        for name, value in header_list:
+            name, value = name.decode("latin-1"), value.decode("latin-1")
+            if name in response_headers:
+                response_headers[name].append(value)
+            else:
+                response_headers[name] = [value]
+        return status, response_headers, response_body
+
+    def _static_handler(
+        method: str, path: str, headers: Dict[str, List[str]]
+    ) -> Tuple[int, Dict[str, List[str]], Union[bytes, FileBody, None]]:
+        """Resolves requests by returning matching files in `static_path`"""
+        method = method.upper()
+        accepted_methods = ("GET", "HEAD")
+        asset = None
+        if method in accepted_methods:
+            asset = _get_static_asset(path)
+        if asset is not None:
+            content_encoding = _negotiate_content_encoding(
+                asset, _get_header(headers, "Accept-Encoding")
+            )
+            content_length = asset.encodings.get(content_encoding, asset.size)
+            etag = _get_variant_etag(asset.etag, content_encoding)
+            response_headers = {
+                "Content-Length": [str(content_length)],
+                "Content-Type": [asset.content_type],
+                "ETag": [etag],
+                "Last-Modified": [asset.last_modified],
+                "Cache-Control": [static_cache_controls[asset.filename]],
+                "Accept-Ranges": ["bytes"],
+            }
+            if content_encoding is not None:
+                response_headers["Content-Encoding"] = [content_encoding]
+            if asset.encodings:
+                response_headers["Vary"] = ["Accept-Encoding"]
+            if_none_match = _get_header(headers, "If-None-Match")
+            if_modified_since = _get_header(headers, "If-Modified-Since")
+            if if_none_match is not None:
+                not_modified = _etag_matches(etag, if_none_match)
+            elif if_modified_since is not None:
+                not_modified = _is_not_modified_since(asset, if_modified_since)
+            else:
+                not_modified = False
+            if not_modified:
+                del response_headers["Content-Length"]
+                response_headers.pop("Content-Encoding", None)
+                return 304, response_headers, b""
+            if method == "HEAD":
+                return 200, response_headers, b""
+            range_header = _get_header(headers, "Range")
+            if_range = _get_header(headers, "If-Range")
+            if range_header is not None and (
+                if_range is None or if_range in (etag, asset.last_modified)
+            ):
+                ranges = _parse_range(range_header, content_length)
+                if ranges is not None:
+                    return _static_range_response(
+                        asset, content_encoding, ranges, response_headers
+                    )
+            if static_file_bodies:
+                filepath = _get_static_filepath(asset, content_encoding)
+                return 200, response_headers, FileBody(filepath, 0, content_length)
+            return 200, response_headers, _read_static_body(asset, content_encoding)
+        elif method not in accepted_methods:
+            return _text_response(401, "Bad Request")
+        else:
+            return _text_response(404, "Not Found")
+
+    def _get_static_asset(path: str) -> Optional[StaticAsset]:
+        """Returns the manifest entry for the path, or None if there's no such file"""
+        if "%" in path:
+            path = unquote(path)
+        if not dev_mode:
+            return static_manifest.get(path)
+        # In development mode, files may be added, changed or removed at any time
+        filename = path.lstrip("/")
+        if ".." in filename.split("/"):
+            return None
+        try:
+            mtime_ns = os.stat(os.path.join(static_path, filename)).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        asset = static_manifest.get(path)
+        if asset is not None and asset.mtime_ns == mtime_ns:
+            return asset
+        filepath = Path(static_path) / filename
+        if mtime_ns is None or not filepath.is_file():
+            static_manifest.pop(path, None)
+            return None
+        asset = read_static_asset(Path(static_path), filename)
+        static_cache_controls[filename] = _get_cache_control(
+            asset, static_cache_control, immutable_pattern
+        )
+        static_manifest[path] = asset
+        return asset
+
+    def _static_range_response(
+        asset: StaticAsset,
+        content_encoding: Optional[str],
+        ranges: List[Tuple[int, int]],
+        response_headers: Dict[str, List[str]],
+    ) -> Tuple[int, Dict[str, List[str]], Union[bytes, FileBody, None]]:
+        """Returns the byte ranges of a static file, as a 206 or 416 response"""
+        size = int(response_headers["Content-Length"][0])
+        if not ranges:
+            response = _text_response(416, "Range Not Satisfiable")
+            response[1]["Content-Range"] = [f"bytes */{size}"]
+            return response
+
+        filepath = _get_static_filepath(asset, content_encoding)
+        response_headers = dict(response_headers)
+        if len(ranges) == 1 and static_file_bodies:
+            start, end = ranges[0]
+            response_headers["Content-Range"] = [f"bytes {start}-{end}/{size}"]
+            response_headers["Content-Length"] = [str(end + 1 - start)]
+            return 206, response_headers, FileBody(filepath, start, end + 1 - start)
+
+        # Slice a memory-mapped view, so only the requested ranges are read
+        with open(filepath, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                parts = [view[start : end + 1] for start, end in ranges]
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            response_headers["Content-Range"] = [f"bytes {start}-{end}/{size}"]
+            response_body = parts[0]
+        else:
+            boundary = secrets.token_hex(16)
+            chunks = []
+            for (start, end), part in zip(ranges, parts):
+                chunks.append(
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {asset.content_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n".encode()
+                )
+                chunks.append(part)
+                chunks.append(b"\r\n")
+            chunks.append(f"--{boundary}--\r\n".encode())
+            response_body = b"".join(chunks)
+            response_headers["Content-Type"] = [
+                f"multipart/byteranges; boundary={boundary}"
+            ]
+        response_headers["Content-Length"] = [str(len(response_body))]
+        return 206, response_headers, response_body
+
+    def _get_static_filepath(
+        asset: StaticAsset, content_encoding: Optional[str] = None
+    ) -> str:
+        """Returns the path of a static file, or of its precompressed variant"""
+        filename = asset.filename
+        if content_encoding is not None:
+            filename += _STATIC_ENCODING_SUFFIXES[content_encoding]
+        return os.path.join(static_path, filename)
+
+    def _read_static_body(
+        asset: StaticAsset, content_encoding: Optional[str] = None
+    ) -> bytes:
+        """Returns the contents of a static file, from the cache if possible"""
+        key = (asset.filename, content_encoding, asset.mtime_ns)
+        body = static_cache.get(key)
+        if body is None:
+            body = Path(_get_static_filepath(asset, content_encoding)).read_bytes()
+            static_cache.put(key, body, size=len(body))
+        return body
+
+    return _root_handler
+
+
+def make_async_proxy_app(
+    proxy_app: Callable,
+    api_workers: Optional[ApiWorkerPool] = None,
+    api_compressor: Optional[ResponseCompressor] = None,
+    api_admission: Optional[AdmissionController] = None,
+) -> Callable:
+    """Builds a proxy application for use on an event loop, which sends requests to
+    the API server without blocking, and runs `proxy_app` on a thread for the rest"""
+
+    async def _root_handler(
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        headers: Dict[str, List[str]],
+        body: Optional[bytes],
+        timeout: float,
+    ) -> Tuple[
+        int,
+        Dict[str, List[str]],
+        Union[bytes, FileBody, ResponseStream, AsyncResponseStream, None],
+    ]:
+        """Root request handler"""
+        if path.startswith("/api/") and api_workers is not None:
+            deadline = time.monotonic() + timeout
+            if api_admission is not None:
+                try:
+                    await api_admission.acquire_async(timeout=timeout)
+                except Overloaded:
+                    return _overloaded_response(api_admission.retry_after)
+            try:
+                response = await _api_server_handler(
+                    method=method,
+                    path=path,
+                    query=query,
+                    headers=headers,
+                    body=body,
+                    timeout=deadline - time.monotonic(),
+                )
+            except BaseException:
+                if api_admission is not None:
+                    api_admission.release()
+                raise
+            if api_admission is not None:
+                if isinstance(response[2], AsyncResponseStream):
+                    response[2].add_close_callback(api_admission.release)
+                else:
+                    api_admission.release()
+            if api_compressor is not None:
+                response = api_compressor.compress(
+                    *response, accept_encoding=_get_header(headers, "Accept-Encoding")
+                )
+            return response
+        # Static files and in-process API apps block, so are resolved on a thread
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            functools.partial(
+                proxy_app,
+                method=method,
+                path=path,
+                query=query,
+                headers=headers,
+                body=body,
+                timeout=timeout,
+            ),
+        )
+
+    async def _api_server_handler(
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        headers: Dict[str, List[str]],
+        body: Optional[bytes],
+        timeout: float,
+    ) -> Tuple[int, Dict[str, List[str]], Union[bytes, AsyncResponseStream]]:
+        """Resolves requests by proxying to the API server, without blocking"""
+        deadline = time.monotonic() + timeout
+        for attempt in range(2):
+            try:
+                worker, connection_pool = api_workers.acquire(timeout=0)
+            except concurrent.futures.TimeoutError:
+                # Wait for an API server to start on a thread
+                try:
+                    loop = asyncio.get_running_loop()
+                    worker, connection_pool = await loop.run_in_executor(
+                        None, api_workers.acquire, max(deadline - time.monotonic(), 0)
+                    )
+                except concurrent.futures.TimeoutError:
+                    return _text_response(503, "Service Unavailable")
+            try:
+                # Timeouts cancel the request, closing its connection
+                status, response_headers, response_body = await asyncio.wait_for(
+                    _api_server_request(
+                        api_connection_pool=connection_pool,
+                        method=method,
+                        path=path,
+                        query=query,
+                        headers=headers,
+                        body=body,
+                    ),
+                    timeout=max(deadline - time.monotonic(), 0),
+                )
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The API server may have exited, so have it checked now, and as
+                # the request wasn't sent, retry it once
+                api_workers.check(worker)
+                api_workers.release(worker)
+                if attempt:
+                    return _text_response(503, "Service Unavailable")
+                continue
+            except asyncio.TimeoutError:
+                api_workers.release(worker)
+                return _text_response(504, "Gateway Timeout")
+            except BaseException:
+                api_workers.release(worker)
+                raise
+            if isinstance(response_body, AsyncResponseStream):
+                # The API server is busy with the request until the body is relayed
+                response_body.add_close_callback(lambda: api_workers.release(worker))
+            else:
+                api_workers.release(worker)
+            return status, response_headers, response_body
+
+    async def _api_server_request(
+        api_connection_pool: HTTPConnectionPool,
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        headers: Dict[str, List[str]],
+        body: Optional[bytes],
+    ) -> Tuple[int, Dict[str, List[str]], Union[bytes, AsyncResponseStream]]:
+        """Sends a request to an API server, on a connection kept open if possible"""
+        url = path
+        if len(query):
+            url += "?" + urlencode(query, doseq=True)
+        head = [f"{method} {url} HTTP/1.1\r\n"]
+        if _get_header(headers, "Host") is None:
+            head.append(f"Host: {api_connection_pool.host}\r\n")
+        for name, values in headers.items():
+            if name.lower() in _HOP_BY_HOP_HEADERS or name.lower() == "content-length":
+                continue
+            for value in values:
+                head.append(f"{name}: {value}\r\n")
+        if body or method.upper() in ("PATCH", "POST", "PUT"):
+            head.append(f"Content-Length: {len(body or b'')}\r\n")
+        request = "".join(head).encode("latin-1") + b"\r\n" + (body or b"")
+
+        reader, writer, reused = await _open_connection(api_connection_pool)
+        try:
+            sent = False
+            try:
+                writer.write(request)
+                await writer.drain()
+                sent = True
+                status_line = await reader.readline()
+            except ConnectionError:
+                if not reused:
+                    raise
+                status_line = b""
+            if not status_line and reused:
+                # A request that was sent may have been acted on already
+                if sent and method.upper() not in _IDEMPOTENT_METHODS:
+                    raise RemoteDisconnected(
+                        "API server closed the connection without response"
+                    )
+                # The API server closed the idle connection as it was being
+                # reused, so retry once on a new connection
+                writer.close()
+                reader, writer = await _connect(api_connection_pool)
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+            # Skip informational responses, such as 100 Continue
+            while True:
+                http_version, status_code = status_line.decode("latin-1").split()[:2]
+                status = int(status_code)
+                response_headers = {}  # type: Dict[str, List[str]]
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, value = line.decode("latin-1").split(":", 1)
+                    response_headers.setdefault(name.strip(), []).append(value.strip())
+                if status >= 200:
+                    break
+                status_line = await reader.readline()
+
+            connection = (_get_header(response_headers, "Connection") or "").lower()
+            will_close = http_version == "HTTP/1.0" or "close" in connection
+            transfer_encoding = _get_header(response_headers, "Transfer-Encoding") or ""
+            content_length = _get_header(response_headers, "Content-Length")
+            if method.upper() == "HEAD" or status in (204, 304):
+                length = 0
+            elif "chunked" in transfer_encoding.lower():
+                length = None
+            elif content_length is not None:
+                length = int(content_length)
+            else:
+                # The body is ended by the API server closing the connection
+                length, will_close = None, True
+            response_headers = {
+                name: values
+                for name, values in response_headers.items()
+                if name.lower() not in _HOP_BY_HOP_HEADERS
+            }
+            if length is not None and length <= _STREAM_CHUNK_SIZE:
+                response_body = await reader.readexactly(length)
+            else:
+                response_body = None
+        except BaseException:
+            writer.close()
+            raise
+        if response_body is not None:
+            api_connection_pool.release_stream(reader, writer, reusable=not will_close)
+            return status, response_headers, response_body
+
+        # Relay large or chunked responses as they're received, and only reuse
+        # the connection if the response is read to the end
+        finished = []
+
+        async def _read_chunks() -> AsyncIterator[bytes]:
+            if length is not None:
+                remaining = length
+                while remaining:
+                    chunk = await reader.read(min(remaining, _STREAM_CHUNK_SIZE))
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b"", remaining)
+                    remaining -= len(chunk)
+                    yield chunk
+            elif "chunked" in transfer_encoding.lower():
+                while True:
+                    size = int((await reader.readline()).split(b";", 1)[0], 16)
+                    if not size:
+                        break
+                    while size:
+                        chunk = await reader.readexactly(min(size, _STREAM_CHUNK_SIZE))
+                        size -= len(chunk)
+                        yield chunk
+                    await reader.readline()
+                while (await reader.readline()).strip():
+                    pass
+            else:
+                while True:
+                    chunk = await reader.read(_STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finished.append(True)
+
+        def _close():
+            if finished:
+                api_connection_pool.release_stream(
+                    reader, writer, reusable=not will_close
+                )
+            else:
+                writer.close()
+
+        return status, response_headers, AsyncResponseStream(_read_chunks(), _close)
+
+    async def _open_connection(
+        api_connection_pool: HTTPConnectionPool,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """Returns an idle connection to the API server if there is one, or else a
+        new one, and whether it was reused"""
+        connection = api_connection_pool.acquire_stream()
+        if connection is not None:
+            return connection[0], connection[1], True
+        reader, writer = await _connect(api_connection_pool)
+        return reader, writer, False
+
+    async def _connect(
+        api_connection_pool: HTTPConnectionPool,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if api_connection_pool.socket_path:
+            return await asyncio.open_unix_connection(api_connection_pool.socket_path)
+        return await asyncio.open_connection(
+            api_connection_pool.host, api_connection_pool.port
+        )
+
+    return _root_handler
+
+
+def _make_wsgi_environ(
+    method: str,
+    path: str,
+    query: Dict[str, List[str]],
+    headers: Dict[str, List[str]],
+    body: Optional[bytes],
+) -> Dict:
+    """Builds the WSGI environ for a request"""
+    if body is None:
+        body = b""
+    elif isinstance(body, str):
+        body = body.encode("utf-8")
+    environ = {
+        "REQUEST_METHOD": method.upper(),
+        "SCRIPT_NAME": "",
+        # WSGI strings are bytes decoded as latin-1
+        "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+        "QUERY_STRING": urlencode(query, doseq=True),
+        "CONTENT_LENGTH": str(len(body)),
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": str(PROXY_PORT),
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, values in headers.items():
+        key = name.upper().replace("-", "_")
+        if key == "CONTENT_LENGTH":
+            continue
+        elif key == "CONTENT_TYPE":
+            environ[key] = values[0]
+        elif key == "COOKIE":
+            environ["HTTP_COOKIE"] = "; ".join(values)
+        else:
+            environ["HTTP_" + key] = ",".join(values)
+    if environ.get("HTTP_X_FORWARDED_PROTO") == "https":
+        environ["wsgi.url_scheme"] = "https"
+    return environ
+
+
+def _make_asgi_scope(
+    method: str,
+    path: str,
+    query: Dict[str, List[str]],
+    headers: Dict[str, List[str]],
+) -> Dict:
+    """Builds the ASGI HTTP connection scope for a request"""
+    header_list = [
+        (name.lower().encode("latin-1"), value.encode("latin-1"))
+        for name, values in headers.items()
+        for value in values
+    ]
+    scheme = "http"
+    for name, values in headers.items():
+        if name.lower() == "x-forwarded-proto" and values[0] == "https":
+            scheme = "https"
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.3"},
+        "http_version": "1.1",
+        "method": method.upper(),
+        "scheme": scheme,
+        "path": unquote(path),
+        "raw_path": path.encode("utf-8"),
+        "query_string": urlencode(query, doseq=True).encode("ascii"),
+        "root_path": "",
+        "headers": header_list,
+        "server": ("localhost", PROXY_PORT),
+        "client": None,
+    }
+
+
+def _is_connection_dropped(connection: HTTPConnection) -> bool:
+    """Returns True if an idle connection has been closed by the server"""
+    if connection.sock is None:
+        return True
+    # An idle connection should have nothing to read, so being readable means
+    # either EOF or an unexpected response, and it can't be reused either way
+    readable, _, _ = select.select([connection.sock], [], [], 0)
+    return bool(readable)
+
+
+def _text_response(
+    status: int, message: str
+) -> Tuple[int, Dict[str, List[str]], bytes]:
+    """Returns a plain text response with the message as its body"""
+    response_body = message.encode("utf-8")
+    return (
+        status,
+        {
+            "Content-Length": [str(len(response_body))],
+            "Content-Type": ["text/plain"],
+        },
+        response_body,
+    )
+
+
+def _overloaded_response(
+    retry_after: int,
+) -> Tuple[int, Dict[str, List[str]], bytes]:
+    """Returns a 503 response for requests rejected by admission control"""
+    status, headers, body = _text_response(503, "Service Unavailable")
+    headers["Retry-After"] = [str(retry_after)]
+    return status, headers, body
+
+
+def _read_chunks(response: HTTPResponse) -> Iterator[bytes]:
+    """Yields the body of an HTTP response in chunks, as they're received"""
+    while True:
+        chunk = response.read1(_STREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _compress_chunks(chunks: Iterable[bytes], compressor) -> Iterator[bytes]:
+    """Yields the compressed form of a body given in chunks"""
+    for chunk in chunks:
+        compressed_chunk = compressor.compress(chunk)
+        if compressed_chunk:
+            yield compressed_chunk
+    yield compressor.flush()
+
+
+async def _compress_chunks_async(
+    chunks: AsyncIterable[bytes], compressor
+) -> AsyncIterator[bytes]:
+    """Yields the compressed form of a body given in chunks by an event loop"""
+    async for chunk in chunks:
+        compressed_chunk = compressor.compress(chunk)
+        if compressed_chunk:
+            yield compressed_chunk
+    yield compressor.flush()
+
+
+def _get_compressed_headers(
+    headers: Dict[str, List[str]], content_encoding: str, length: Optional[int]
+) -> Dict[str, List[str]]:
+    """Returns response headers updated for a compressed body of the given length"""
+    vary = _get_header(headers, "Vary")
+    etag = _get_header(headers, "ETag")
+    headers = {
+        name: values
+        for name, values in headers.items()
+        if name.lower() not in ("content-length", "vary", "etag")
+    }
+    if length is not None:
+        headers["Content-Length"] = [str(length)]
+    if etag is not None and etag.endswith('"'):
+        # The compressed body is a different representation, so needs its own tag
+        headers["ETag"] = [_get_variant_etag(etag, content_encoding)]
+    headers["Content-Encoding"] = [content_encoding]
+    headers["Vary"] = [vary + ", Accept-Encoding" if vary else "Accept-Encoding"]
+    return headers
+
+
+def _get_header(headers: Dict[str, List[str]], name: str) -> Optional[str]:
+    """Returns the comma-joined values of a request header, or None if missing"""
+    name = name.lower()
+    for header_name, values in headers.items():
+        if header_name.lower() == name:
+            return ",".join(values)
+    return None
+
+
+def _parse_accept_encoding(accept_encoding: str) -> Dict[str, float]:
+    """Parses an Accept-Encoding header value into quality values by coding"""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = item.strip().lower().split(";")
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip()] = quality
+    return qualities
+
+
+def _negotiate_content_encoding(
+    asset: StaticAsset, accept_encoding: Optional[str]
+) -> Optional[str]:
+    """Returns the coding of the smallest acceptable variant, or None for identity"""
+    if not asset.encodings or not accept_encoding:
+        return None
+    qualities = _parse_accept_encoding(accept_encoding)
+    best_coding, best_size = None, asset.size
+    for coding, size in asset.encodings.items():
+        if qualities.get(coding, qualities.get("*", 0.0)) > 0 and size < best_size:
+            best_coding, best_size = coding, size
+    return best_coding
+
+
+def _get_variant_etag(etag: str, content_encoding: Optional[str]) -> str:
+    """Returns the entity tag of a content-coded variant of a static file or API
+    response"""
+    if content_encoding is None:
+        return etag
+    # Each variant is a different representation, so needs a different strong tag
+    return etag[:-1] + "-" + content_encoding + '"'
+
+
+def _etag_matches(etag: str, if_none_match: str) -> bool:
+    """Returns True if an If-None-Match header value matches the entity tag"""
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison function, ignoring weakness indicators
+    etag = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _is_not_modified_since(asset: StaticAsset, if_modified_since: str) -> bool:
+    """Returns True if a static file is unchanged since an If-Modified-Since date"""
+    # Clients usually send back the Last-Modified value they were given
+    if if_modified_since == asset.last_modified:
+        return True
+    timestamp = _parse_http_date(if_modified_since)
+    return timestamp is not None and asset.mtime_ns // 1_000_000_000 <= timestamp
+
+
+@lru_cache(maxsize=1024)
+def _parse_http_date(value: str) -> Optional[int]:
+    """Parses an HTTP date into a Unix timestamp, or returns None if it's invalid"""
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def _parse_range(range_header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """Parses a Range header value into inclusive byte ranges within the size"""
+    # Returns an empty list if no range is satisfiable, or None if it's invalid
+    unit, _, range_set = range_header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    specs = range_set.split(",")
+    # Requests for many ranges are more likely abuse than useful, so are ignored
+    if len(specs) > 16:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = (part.strip() for part in spec.partition("-"))
+        if not dash or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # Suffix range, for the last bytes of the file
+            start, end = max(size - int(last), 0), size - 1
+            if int(last) == 0:
+                continue
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        if start < size:
+            ranges.append((start, end))
+    return ranges
+
+
+def _is_binary_content(headers: Dict[str, List[str]]) -> bool:
+    """Returns True if the headers indicate binary content"""
+    content_type = "text/plain"
+    content_encoding = "identity"
+    for name, values in headers.items():
+        if name.lower() == "content-type":
+            content_type = values[0]
+        if name.lower() == "content-encoding":
+            content_encoding = values[0].strip().lower()
+    if content_encoding != "identity":
+        return True
+    if _is_text_content_type(content_type):
+        return False
+    return True
+
+
+def _is_text_content_type(content_type: str) -> bool:
+    """Returns True if the Content-Type value indicates text content"""
+    if content_type.startswith("text/"):
+        return True
+    elif content_type.startswith("application/javascript"):
+        return True
+    elif content_type.startswith("application/json"):
+        return True
+    elif content_type.startswith("image/svg+xml"):
+        return True
+    return False
 
-one_time_init()
 
 if __name__ == "__main__":
     main()
+else:
+    one_time_init()